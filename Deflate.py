@@ -0,0 +1,70 @@
+import zlib
+import struct
+
+## what precompress() puts before the deflated body: its CRC-32 and length, and
+## the CRC-32 shift for its length (see shift())
+HEADER_FORMAT = '<II32I'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+## gzip member header: magic, deflate, no flags, no mtime, no extra flags, unknown OS
+GZIP_HEADER = '\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+## the most a stored block can hold
+STORED_SIZE = 65535
+
+def precompress(body):
+    """
+    the body deflated once, so it can be sent gzipped between any head and tail
+    (see gzip_parts()): a header with its CRC-32, its length and the operator
+    that shifts a CRC-32 over that many bytes, then the raw deflate stream,
+    ending on a byte boundary with a sync flush and no final block
+    """
+    ## a CRC-32 is affine in the CRC it starts from, and its linear part only
+    ## depends on the length: the CRC of head + body is shift(CRC of head)
+    ## xor the CRC of the body
+    zeros = '\0' * len(body)
+    base = zlib.crc32(zeros, 0) & 0xffffffff
+    operator = [(zlib.crc32(zeros, 1 << bit) & 0xffffffff) ^ base for bit in xrange(32)]
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(body) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return struct.pack(HEADER_FORMAT, zlib.crc32(body) & 0xffffffff, len(body), *operator) + deflated
+
+def read_header(f):
+    """
+    the (crc, length, operator) at the start of a file written with precompress(),
+    which is left at the deflate stream
+    """
+    fields = struct.unpack(HEADER_FORMAT, f.read(HEADER_SIZE))
+    return fields[0], fields[1], fields[2:]
+
+def shift(operator, crc):
+    ## the CRC-32 of head + body, but the one of the body, from the one of head
+    result = 0
+    for bit in xrange(32):
+        if crc >> bit & 1:
+            result ^= operator[bit]
+    return result
+
+def stored(data, final):
+    """
+    data as deflate stored blocks, the last one final if asked; they start and
+    end on a byte boundary
+    """
+    blocks = []
+    for offset in xrange(0, max(len(data), 1), STORED_SIZE):
+        piece = data[offset:offset + STORED_SIZE]
+        last = final and offset + STORED_SIZE >= len(data)
+        blocks.append(chr(1 if last else 0) + struct.pack('<HH', len(piece), len(piece) ^ 0xffff) + piece)
+    return ''.join(blocks)
+
+def gzip_parts(head, header, tail):
+    """
+    the gzip member for head + body + tail, given the header of the precompressed
+    body: what goes before and after its deflate stream
+    """
+    crc, length, operator = header
+    crc = shift(operator, zlib.crc32(head) & 0xffffffff) ^ crc
+    crc = zlib.crc32(tail, crc) & 0xffffffff
+    size = (len(head) + length + len(tail)) & 0xffffffff
+    return GZIP_HEADER + stored(head, False), stored(tail, True) + struct.pack('<II', crc, size)
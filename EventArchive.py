@@ -0,0 +1,177 @@
+import os
+import json
+
+import Constants
+from LogLineEvent import LogLineEvent
+from Metrics import metrics
+
+class EventArchive:
+    """
+    EventArchive keeps the events accounted for in the datapoints, in a directory
+    (the data filename + '.events') of segment files and an index. Each event is a
+    tab-separated record with its timestamp, type code and ids, so the events can
+    be read again without parsing the log:
+        timestamp  type  user_id  username  room_id  audio_id
+    (ids are escaped, and missing ones are written as \N).
+
+    A segment is closed once it's SEGMENT_BYTES long or spans SEGMENT_SECONDS,
+    and the index keeps the name, time range, number of records and size of
+    each one, so reading a time range only opens the segments it overlaps.
+    Records are written through a single buffered file, and reach the disk
+    (with the index) on flush().
+    """
+
+    SEGMENT_BYTES = 8 * 1024 * 1024
+    SEGMENT_SECONDS = Constants.SECONDS_IN_DAY
+    BUFFER_SIZE = 65536
+
+    def __init__(self, directory, readonly=False):
+        self.__directory__ = directory
+        self.__indexfile__ = os.path.join(directory, 'index')
+        self.__readonly__ = readonly
+        self.__file__ = None
+
+        if not readonly and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.__segments__ = self.__readIndex__()
+        if not readonly and len(self.__segments__) > 0:
+            self.__recover__(self.__segments__[-1])
+
+    def __readIndex__(self):
+        try:
+            f = open(self.__indexfile__, 'r')
+            index = json.loads(f.read())
+            f.close()
+        except (IOError, ValueError):
+            return []
+        return index['segments']
+
+    def __writeIndex__(self):
+        tmpname = self.__indexfile__ + '.tmp'
+        f = open(tmpname, 'w')
+        f.write(json.dumps({'segments': self.__segments__}) + '\n')
+        f.close()
+        os.rename(tmpname, self.__indexfile__)
+
+    def __path__(self, segment):
+        return os.path.join(self.__directory__, segment['name'])
+
+    def __recover__(self, segment):
+        # the index is saved after the records, so the last segment can have
+        # records it doesn't count yet (and half a record, if we stopped while
+        # writing it); count them, and drop the half record
+        try:
+            size = os.path.getsize(self.__path__(segment))
+        except OSError:
+            size = 0
+        if size == segment['bytes']: return
+
+        if size < segment['bytes']:
+            segment.update({'first': None, 'last': None, 'records': 0, 'bytes': 0})
+
+        f = open(self.__path__(segment), 'r+b')
+        f.seek(segment['bytes'])
+        data = f.read()
+        data = data[:data.rfind('\n') + 1]
+        for line in data.splitlines():
+            self.__count__(segment, int(line[:line.find('\t')]), 0)
+        segment['bytes'] += len(data)
+        f.truncate(segment['bytes'])
+        f.close()
+        self.__writeIndex__()
+
+    def __count__(self, segment, timestamp, size):
+        if segment['first'] is None:
+            segment['first'] = segment['last'] = timestamp
+        segment['last'] = max(segment['last'], timestamp)
+        segment['records'] += 1
+        segment['bytes'] += size
+
+    def __rotate__(self):
+        if self.__file__ is not None:
+            self.__file__.close()
+        number = 0
+        if len(self.__segments__) > 0:
+            number = int(self.__segments__[-1]['name'][len('segment-'):-len('.tsv')]) + 1
+        segment = {'name': 'segment-%06d.tsv' % number, 'first': None, 'last': None, 'records': 0, 'bytes': 0}
+        self.__segments__.append(segment)
+        self.__file__ = open(self.__path__(segment), 'ab', EventArchive.BUFFER_SIZE)
+        return segment
+
+    def write(self, events):
+        """
+        appends the events, in the order given
+        """
+        for event in events:
+            timestamp = event.timestamp()
+            segment = self.__segments__ and self.__segments__[-1]
+            if not segment or segment['bytes'] >= EventArchive.SEGMENT_BYTES or \
+                    (segment['first'] is not None and timestamp - segment['first'] >= EventArchive.SEGMENT_SECONDS):
+                segment = self.__rotate__()
+            elif self.__file__ is None:
+                self.__file__ = open(self.__path__(segment), 'ab', EventArchive.BUFFER_SIZE)
+
+            record = format_record(event.record())
+            self.__file__.write(record)
+            self.__count__(segment, timestamp, len(record))
+            metrics.count('events_archived')
+
+    def flush(self):
+        """
+        writes the buffered records and the index
+        """
+        if self.__file__ is None: return
+        self.__file__.flush()
+        self.__writeIndex__()
+
+    def close(self):
+        self.flush()
+        if self.__file__ is not None:
+            self.__file__.close()
+            self.__file__ = None
+
+    def segments(self):
+        return list(self.__segments__)
+
+    def events(self, start=None, end=None):
+        """
+        generator with the archived events with start <= timestamp < end (both
+        optional), in the order they were written
+        """
+        self.flush()
+        for segment in self.__segments__:
+            if segment['records'] == 0: continue
+            if start is not None and segment['last'] < start: continue
+            if end is not None and segment['first'] >= end: continue
+
+            f = open(self.__path__(segment), 'rb')
+            data = f.read(segment['bytes'])
+            f.close()
+            for line in data.splitlines():
+                record = parse_record(line)
+                if start is not None and record[0] < start: continue
+                if end is not None and record[0] >= end: continue
+                yield LogLineEvent.from_record(record)
+
+    def replay(self, statTable, start=None, end=None):
+        """
+        updates statTable with the archived events in a time range, as it would
+        have been by parsing the log
+        """
+        statTable.update(self.events(start, end))
+
+def format_record(record):
+    timestamp, event_type = record[:2]
+    fields = ['%d' % timestamp, '%d' % event_type]
+    for value in record[2:]:
+        if value is None:
+            fields.append('\\N')
+        else:
+            fields.append(value.encode('string_escape'))
+    return '\t'.join(fields) + '\n'
+
+def parse_record(line):
+    fields = line.split('\t')
+    values = [None if value == '\\N' else intern(value.decode('string_escape')) for value in fields[2:]]
+    return tuple([int(fields[0]), int(fields[1])] + values)
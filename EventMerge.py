@@ -0,0 +1,50 @@
+import heapq
+
+from Metrics import metrics
+
+## seconds an event can be behind a later one and still be put in order
+REORDER_SECONDS = 5
+
+def merge(sources, reorder_seconds=REORDER_SECONDS):
+    """
+    generator merging several streams of events (such as the ones iterparse()
+    returns for each log) into a single one sorted by timestamp, as StatTable.update
+    needs, down to the millisecond the lines were logged at (a user's name and its
+    audio id can be logged in the same second, in different logs). The streams are
+    read lazily, always the one furthest behind, and their events wait in a heap
+    until no stream can have an earlier one: every stream has reached
+    reorder_seconds past it (the watermark). So lines a few seconds out of order,
+    within a log or between logs, still come out in order, and only the events of
+    the last reorder_seconds are kept in memory, however many logs there are.
+    Events logged at the same millisecond keep the order they were read in.
+
+    An event later than that is handed out with the timestamp of the last one (so
+    it's still accounted for) and counted in the late_events metric.
+    """
+    sources = [iter(source) for source in sources]
+
+    ## (latest timestamp read, number) of the streams not exhausted yet, and
+    ## (timestamp, milliseconds, order read, event) of the events not handed out yet
+    waiting = [(float('-inf'), number) for number in xrange(len(sources))]
+    buffered = []
+    order = 0
+    latest = None
+
+    while waiting or buffered:
+        if waiting:
+            read, number = heapq.heappop(waiting)
+            for event in sources[number]:
+                timestamp = event.timestamp()
+                heapq.heappush(buffered, (timestamp, event.millis(), order, event))
+                heapq.heappush(waiting, (max(read, timestamp), number))
+                order += 1
+                break
+
+        while buffered and (not waiting or buffered[0][0] <= waiting[0][0] - reorder_seconds):
+            timestamp, millis, order_read, event = heapq.heappop(buffered)
+            if latest is not None and timestamp < latest:
+                event.__timestamp__ = latest
+                metrics.count('late_events')
+            else:
+                latest = timestamp
+            yield event
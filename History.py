@@ -0,0 +1,223 @@
+import os
+import re
+import json
+import time
+import math
+
+import Series
+from Metrics import metrics
+
+def expand(record, start=None, end=None):
+    """
+    the datapoints of a record written by History.write_run() with start <=
+    timestamp <= end (both optional); other records are a single datapoint
+    """
+    run = record.pop('run', None)
+    if run is None:
+        return [record]
+
+    count, seconds, idxs = run
+    first, last = 0, count
+    if start is not None:
+        first = max(first, int(math.ceil(float(start - record['timestamp']) / seconds)))
+    if end is not None:
+        last = min(last, int(math.floor(float(end - record['timestamp']) / seconds)) + 1)
+    return [{'timestamp': record['timestamp'] + n * seconds, 'idx': record['idx'] + n * idxs,
+        'value': record['value']} for n in xrange(first, last)]
+
+class History:
+    """
+    History keeps the datapoints StatTable slides out of its windows, so they
+    are not lost once they are older than a window covers. It's a directory
+    (the data filename + '.history') with a file per window and month, named
+    after them (daily-2012-05.json, ...), where the datapoints are appended as
+    they are trimmed, one JSON object per line, and an index with the time
+    range, number of datapoints and size of each file. Reading a time range only
+    opens the files it overlaps.
+
+    Datapoints are written through buffered files and reach the disk (with the
+    index) on flush(). Datapoints no newer than the latest one of their window
+    are skipped, so the ones trimmed again after an interrupted run (the data
+    file didn't get to be written) are not added twice; timestamps are used
+    rather than idxs, which start over if the data is rebuilt. The datapoints of
+    a long idle period, which StatTable fills in bulk without ever keeping them
+    in its windows, are written as a single record with a 'run' (see write_run())
+    and expanded when read. If the index is lost or damaged, it's made again
+    from the files.
+    """
+
+    BUFFER_SIZE = 65536
+
+    ## the name of a partition file: window, year and month
+    PARTITION = re.compile(r'^([a-z]+)-\d{4}-\d{2}\.json$')
+
+    def __init__(self, directory, readonly=False):
+        self.__directory__ = directory
+        self.__indexfile__ = os.path.join(directory, 'index')
+        self.__readonly__ = readonly
+        self.__files__ = {}
+
+        if not readonly and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.__windows__ = self.__readIndex__()
+        if self.__windows__ is None:
+            self.__windows__ = self.__rebuildIndex__()
+            if not readonly:
+                self.__writeIndex__()
+        if not readonly:
+            self.__recover__()
+
+    def __readIndex__(self):
+        try:
+            f = open(self.__indexfile__, 'r')
+            index = json.loads(f.read())
+            f.close()
+            return index['windows']
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+
+    def __rebuildIndex__(self):
+        # the index of the partition files as they are, up to the last
+        # complete line of each; files are sorted by window and month
+        windows = {}
+        try:
+            names = sorted(os.listdir(self.__directory__))
+        except OSError:
+            names = []
+
+        for name in names:
+            match = History.PARTITION.match(name)
+            if match is None: continue
+            partition = {'name': name, 'first': None, 'last': None, 'count': 0, 'bytes': 0}
+            f = open(os.path.join(self.__directory__, name), 'rb')
+            for line in f:
+                try:
+                    if not line.endswith('\n'): raise ValueError
+                    datapoint = json.loads(line)
+                    count, seconds, idxs = datapoint.get('run', (1, 0, 0))
+                    timestamp = datapoint['timestamp']
+                except (ValueError, KeyError, TypeError):
+                    break
+                if partition['first'] is None:
+                    partition['first'] = timestamp
+                partition['last'] = timestamp + (count - 1) * seconds
+                partition['count'] += count
+                partition['bytes'] += len(line)
+            f.close()
+
+            if partition['count'] > 0:
+                windows.setdefault(match.group(1), {'partitions': []})['partitions'].append(partition)
+        return windows
+
+    def __writeIndex__(self):
+        tmpname = self.__indexfile__ + '.tmp'
+        f = open(tmpname, 'w')
+        f.write(json.dumps({'windows': self.__windows__}) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmpname, self.__indexfile__)
+
+    def __path__(self, partition):
+        return os.path.join(self.__directory__, partition['name'])
+
+    def __recover__(self):
+        # datapoints written after the last index are dropped; the data file
+        # was not written after them either, so they'll be trimmed again. Files
+        # of a window not in the index can only be for months after its last one
+        names = set([partition['name'] for window in self.__windows__.values()
+            for partition in window['partitions']])
+        for name in os.listdir(self.__directory__):
+            if name not in names and name != 'index':
+                os.remove(os.path.join(self.__directory__, name))
+
+        for window in self.__windows__.values():
+            for partition in window['partitions']:
+                try:
+                    size = os.path.getsize(self.__path__(partition))
+                except OSError:
+                    continue
+                if size > partition['bytes']:
+                    f = open(self.__path__(partition), 'r+b')
+                    f.truncate(partition['bytes'])
+                    f.close()
+
+    def write(self, key, datapoints):
+        """
+        appends the datapoints trimmed from a window, oldest first
+        """
+        for datapoint in datapoints:
+            self.__append__(key, datapoint, datapoint['timestamp'], 1)
+
+    def write_run(self, key, datapoint, count, seconds, idxs):
+        """
+        appends count datapoints with the value of datapoint, the first one being
+        datapoint and each of the others seconds and idxs after the previous one,
+        as a single record
+        """
+        self.__append__(key, dict(datapoint, run=[count, seconds, idxs]),
+            datapoint['timestamp'] + (count - 1) * seconds, count)
+
+    def __append__(self, key, record, last, count):
+        window = self.__windows__.setdefault(key, {'partitions': []})
+        if len(window['partitions']) > 0 and record['timestamp'] <= window['partitions'][-1]['last']:
+            return
+
+        name = '%s-%s.json' % (key, time.strftime('%Y-%m', time.gmtime(record['timestamp'])))
+        partitions = window['partitions']
+        if len(partitions) == 0 or partitions[-1]['name'] != name:
+            partitions.append({'name': name, 'first': record['timestamp'], 'last': None, 'count': 0, 'bytes': 0})
+        partition = partitions[-1]
+
+        f = self.__files__.get(key)
+        if f is None or f.name != self.__path__(partition):
+            if f is not None:
+                f.close()
+            f = open(self.__path__(partition), 'ab', History.BUFFER_SIZE)
+            self.__files__[key] = f
+
+        line = json.dumps(record) + '\n'
+        f.write(line)
+        partition['last'] = last
+        partition['count'] += count
+        partition['bytes'] += len(line)
+        metrics.count('datapoints_archived', key, count)
+
+    def flush(self):
+        """
+        writes the buffered datapoints and the index
+        """
+        if len(self.__files__) == 0: return
+        ## the index never counts datapoints not on the disk yet
+        for f in self.__files__.values():
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+        self.__files__ = {}
+        self.__writeIndex__()
+
+    def partitions(self, key):
+        return list(self.__windows__.get(key, {'partitions': []})['partitions'])
+
+    def datapoints(self, key, start=None, end=None):
+        """
+        the datapoints of a window with start <= timestamp <= end (both optional),
+        oldest first
+        """
+        self.flush()
+        result = []
+        for partition in self.partitions(key):
+            if partition['count'] == 0: continue
+            if start is not None and partition['last'] < start: continue
+            if end is not None and partition['first'] > end: continue
+
+            f = open(self.__path__(partition), 'rb')
+            data = f.read(partition['bytes'])
+            f.close()
+            datapoints = []
+            for line in data.splitlines():
+                datapoints.extend(expand(json.loads(line), start, end))
+            result.extend(Series.time_range(datapoints,
+                [datapoint['timestamp'] for datapoint in datapoints], start, end))
+        return result
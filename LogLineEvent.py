@@ -1,71 +1,125 @@
 import re
-import dateutil.parser
+import gzip
+import time
 import calendar
 
+from Metrics import metrics
+
+## epoch values for the "YYYY-MM-DD HH:MM:SS" prefixes seen recently; events
+## come in bursts, so most lines hit the cache
+TIMESTAMP_CACHE_SIZE = 1024
+timestamp_cache = {}
+
+def parse_timestamp(line):
+    """
+    returns the timestamp of the "YYYY-MM-DD HH:MM:SS,mmm" prefix that Red5 writes
+    at the start of each line. Lines in any other format go through dateutil
+    """
+    prefix = line[:19]
+    try:
+        return timestamp_cache[prefix]
+    except KeyError:
+        pass
+
+    try:
+        if prefix[4] != '-' or prefix[7] != '-' or prefix[10] != ' ' \
+                or prefix[13] != ':' or prefix[16] != ':' or line[19:20] not in ',. ':
+            raise ValueError
+        fields = (int(prefix[0:4]), int(prefix[5:7]), int(prefix[8:10]),
+            int(prefix[11:13]), int(prefix[14:16]), int(prefix[17:19]))
+        if not (1 <= fields[1] <= 12 and 1 <= fields[2] <= 31 and fields[3] < 24 \
+                and fields[4] < 60 and fields[5] < 60):
+            raise ValueError
+    except (ValueError, IndexError):
+        return parse_timestamp_fallback(line)
+
+    timestamp = calendar.timegm(fields)
+    if len(timestamp_cache) >= TIMESTAMP_CACHE_SIZE:
+        timestamp_cache.clear()
+    timestamp_cache[prefix] = timestamp
+    return timestamp
+
+def parse_millis(line):
+    """
+    returns the milliseconds of the timestamp prefix, or 0 if the line has none
+    """
+    millis = line[20:23]
+    if line[19:20] in ',.' and millis.isdigit():
+        return int(millis)
+    return 0
+
+def parse_timestamp_fallback(line):
+    ## only imported when needed, it's slow to load and slow to run
+    import dateutil.parser
+
+    tokens = line.split(" ",2)
+    datetime = " ".join(tokens[0:2]).replace(',','.')
+    return calendar.timegm(dateutil.parser.parse(datetime).timetuple())
+
 def parse_user_join(line, regex_match):
     result = LogLineEvent(line)
     result.__type__ = LogLineEvent.USER_JOIN
-    result.__user_id__ = regex_match.group("user_id")
+    result.__user_id__ = intern(regex_match.group("user_id"))
     return result
 
 def parse_user_leave(line, regex_match):
     result = LogLineEvent(line)
     result.__type__ = LogLineEvent.USER_LEAVE
-    result.__user_id__ = regex_match.group("user_id")
+    result.__user_id__ = intern(regex_match.group("user_id"))
     return result
 
 def parse_user_name(line, regex_match):
     result = LogLineEvent(line)
     result.__type__ = LogLineEvent.USER_NAME
-    result.__user_id__ = regex_match.group('user_id')
-    result.__username__ = regex_match.group('user_name')
-    result.__room_id__ = regex_match.group('room_id')
+    result.__user_id__ = intern(regex_match.group('user_id'))
+    result.__username__ = intern(regex_match.group('user_name'))
+    result.__room_id__ = intern(regex_match.group('room_id'))
     return result
 
 def parse_room_create(line, regex_match):
     result = LogLineEvent(line)
     result.__type__ = LogLineEvent.ROOM_CREATE
     ## unused
-    result.__room_id__ = regex_match.group("room_id")
+    result.__room_id__ = intern(regex_match.group("room_id"))
     return result
 
 def parse_room_destroy(line, regex_match):
     result = LogLineEvent(line)
     result.__type__ = LogLineEvent.ROOM_DESTROY
-    result.__room_id__ = regex_match.group("room_id")
+    result.__room_id__ = intern(regex_match.group("room_id"))
     return result
 
 def parse_video_start(line, regex_match):
     result = LogLineEvent(line)
     result.__type__ = LogLineEvent.VIDEO_START
-    result.__user_id__ = regex_match.group("user_id")
+    result.__user_id__ = intern(regex_match.group("user_id"))
     return result
 
 def parse_video_stop(line, regex_match):
     result = LogLineEvent(line)
     result.__type__ = LogLineEvent.VIDEO_STOP
-    result.__user_id__ = regex_match.group("user_id")
+    result.__user_id__ = intern(regex_match.group("user_id"))
     return result
 
 def parse_audio_start(line, regex_match):
     result = LogLineEvent(line)
     result.__type__ = LogLineEvent.AUDIO_START
     ## unused
-    result.__room_id__ = regex_match.group("room_id")
-    result.__username__ = regex_match.group("user_name")
+    result.__room_id__ = intern(regex_match.group("room_id"))
+    result.__username__ = intern(regex_match.group("user_name"))
     return result
 
 def parse_audio_id(line, regex_match):
     result = LogLineEvent(line)
     result.__type__ = LogLineEvent.AUDIO_ID
-    result.__audio_id__ = regex_match.group('audio_id')
-    result.__username__ = regex_match.group('user_name')
+    result.__audio_id__ = intern(regex_match.group('audio_id'))
+    result.__username__ = intern(regex_match.group('user_name'))
     return result
 
 def parse_audio_stop(line, regex_match):
     result = LogLineEvent(line)
     result.__type__ = LogLineEvent.AUDIO_STOP
-    result.__audio_id__ = regex_match.group("audio_id")
+    result.__audio_id__ = intern(regex_match.group("audio_id"))
     return result
     
 def parse_server_restarted(line, regex_match):
@@ -73,31 +127,83 @@ def parse_server_restarted(line, regex_match):
     result.__type__ = LogLineEvent.SERVER_RESTARTED
     return result    
  
-def parse(filename, events=None):
+def classify(line, keep_line=False):
+    """
+    returns the event for a single log line, or None if the line is not one
+    we care about. The logger name is looked up once, and only the patterns
+    registered for that logger whose message starts as expected are tried
+    against the message. The event only keeps the line itself if keep_line is set
+    """
+    ## the thread name, in brackets before the level, may itself hold ' - '
+    sep = line.find(' - ', line.find('] ') + 1)
+    if sep < 0: return None
+
+    extractors = LogLineEvent.extractors.get(line[line.rfind(' ', 0, sep) + 1:sep])
+    if extractors is None: return None
+
+    message = sep + 3
+    for marker, start, regex, handler in extractors:
+        if not line.startswith(start, message) or not line.endswith(marker, 0, sep): continue
+        match = regex.match(line, message)
+        if match:
+            event = handler(line, match)
+            if not keep_line:
+                event.__line__ = None
+            return event
+    return None
+
+def iterparse(filename, tail=None, keep_lines=False):
+    """
+    generator version of parse(): the log is read line by line and each
+    event is yielded as soon as it's found, so nothing but the current
+    line is kept in memory. If a LogTail is given, only the lines appended
+    since its last checkpoint are parsed. Rotated logs compressed with gzip
+    (ending in '.gz') are decompressed as they are read. Only with keep_lines
+    the events hold their log lines (the EventArchive doesn't need them)
+    """
+    if tail is not None:
+        lines = tail.lines()
+    else:
+        try:
+            if filename.endswith('.gz'):
+                lines = gzip.open(filename, 'rb')
+            else:
+                lines = open(filename, 'r')
+        except:
+            lines = []
+
+    ## the time spent here (between the events handed out) is the parse time
+    count = 0
+    start = time.time()
     try:
-        f = open(filename, 'r')
-        lines = f.readlines()
-        f.close()
-    except:
-        lines = []
+        for line in lines:
+            count += 1
+            event = classify(line, keep_lines)
+            if event is not None:
+                metrics.count('events', LogLineEvent.EventTypeNames[event.__type__])
+                metrics.add_time('parse', time.time() - start)
+                yield event
+                start = time.time()
+    finally:
+        metrics.add_time('parse', time.time() - start)
+        metrics.count('lines', amount=count)
 
+def parse(filename, events=None, tail=None, keep_lines=False):
+    """
+    parses the log file into a list of events
+    """
     if events is None:
         events = []
 
-    for line in lines:
-        for regex in LogLineEvent.regexes:
-            match = regex.match(line)
-            if match: 
-                events.append(LogLineEvent.regexes[regex](line, match))
-
+    events.extend(iterparse(filename, tail, keep_lines))
     return events
 
-class LogLineEvent:
+class LogLineEvent(object):
     """
     LogLineEvent is the base class for all event classes that handle
     single lines of the BigBlueButton log. It contains three important
     fields: self.__type__, self.__timestamp__ and self.__id__. __type__ is one
-    of:
+    of (integer codes, see below):
         USER_JOIN
         USER_LEAVE
         AUDIO_START
@@ -110,81 +216,136 @@ class LogLineEvent:
 
     __timestamp__ contains a timestamp that identifies the event in time, and __id__
     contains an identifier for the user or room that originated the event.
+
+    Initial imports keep millions of events around, so they are kept small: the
+    fields are slots instead of a per-instance dict, the ids are interned, and
+    the raw line is only kept when asked for (otherwise line() returns None).
     """
-    ## each of these regular expressions handles one specific event
-    regexes = {
-        re.compile(".*INFO  o.b.c.BigBlueButtonApplication - \[clientid=(?P<user_id>.*)\] connected.*") : parse_user_join,
-        ### YES! bigbluebutton cannot spell
-        re.compile(".*INFO  o.b.c.BigBlueButtonApplication - \[clientid=(?P<user_id>.*)\] disconnnected.*") : parse_user_leave,
-        re.compile(".*DEBUG o.b.c.BigBlueButtonApplication - User \[userid=(?P<user_id>.*),username=(?P<user_name>.*),role.* connected to room \[(?P<room_id>.*)\]") : parse_user_name,
-        re.compile(".*INFO  o.b.c.s.p.ParticipantsApplication - Creating room (?P<room_id>.*)") : parse_room_create,
-        re.compile(".*INFO  o.b.c.s.p.ParticipantsApplication - Destroying room (?P<room_id>.*)") : parse_room_destroy,
-        re.compile(".*DEBUG o.b.conference.RoomsManager - Change participant status (?P<user_id>.*) - hasStream \[true\]") : parse_video_start,
-        re.compile(".*DEBUG o.b.conference.RoomsManager - Change participant status (?P<user_id>.*) - hasStream \[false\]") : parse_video_stop,
-        re.compile(".*DEBUG o.b.w.red5.voice.ClientManager - Participant (?P<user_name>.*)joining room (?P<room_id>.*)") : parse_audio_start,
-        re.compile(".*DEBUG o.b.w.voice.internal.RoomManager - Joined \[(?P<audio_id>.*),(?P<user_name>.*),.*,.*\]*") : parse_audio_id,
-        re.compile(".*DEBUG o.b.w.red5.voice.ClientManager - Participant \[(?P<audio_id>.*),.*\] leaving") : parse_audio_stop,
-        re.compile(".*DEBUG ROOT - Starting up context bigbluebutton") : parse_server_restarted
+    __slots__ = ['__type__', '__timestamp__', '__millis__', '__user_id__', '__username__',
+        '__room_id__', '__audio_id__', '__line__']
+
+    ## each of these regular expressions handles one specific event; they are
+    ## grouped by the logger that writes the line and matched against the
+    ## message only, right after the "LEVEL logger - " prefix, when it starts
+    ## with the given text. Ids stop at the delimiter that follows them, so a
+    ## message that doesn't match fails without backtracking over the line;
+    ## names (which can have any character) still go up to the last delimiter
+    extractors = {
+        'o.b.c.BigBlueButtonApplication': [
+            ('INFO  o.b.c.BigBlueButtonApplication', '[clientid=', re.compile("\[clientid=(?P<user_id>[^\]]*)\] connected"), parse_user_join),
+            ### YES! bigbluebutton cannot spell
+            ('INFO  o.b.c.BigBlueButtonApplication', '[clientid=', re.compile("\[clientid=(?P<user_id>[^\]]*)\] disconnnected"), parse_user_leave),
+            ('DEBUG o.b.c.BigBlueButtonApplication', 'User [userid=', re.compile("User \[userid=(?P<user_id>[^,]*),username=(?P<user_name>.*),role.* connected to room \[(?P<room_id>.*)\]"), parse_user_name)
+        ],
+        'o.b.c.s.p.ParticipantsApplication': [
+            ('INFO  o.b.c.s.p.ParticipantsApplication', 'Creating room ', re.compile("Creating room (?P<room_id>.*)"), parse_room_create),
+            ('INFO  o.b.c.s.p.ParticipantsApplication', 'Destroying room ', re.compile("Destroying room (?P<room_id>.*)"), parse_room_destroy)
+        ],
+        'o.b.conference.RoomsManager': [
+            ('DEBUG o.b.conference.RoomsManager', 'Change participant status ', re.compile("Change participant status (?P<user_id>[^ ]*) - hasStream \[true\]"), parse_video_start),
+            ('DEBUG o.b.conference.RoomsManager', 'Change participant status ', re.compile("Change participant status (?P<user_id>[^ ]*) - hasStream \[false\]"), parse_video_stop)
+        ],
+        'o.b.w.red5.voice.ClientManager': [
+            ('DEBUG o.b.w.red5.voice.ClientManager', 'Participant ', re.compile("Participant (?P<user_name>.*)joining room (?P<room_id>.*)"), parse_audio_start),
+            ('DEBUG o.b.w.red5.voice.ClientManager', 'Participant [', re.compile("Participant \[(?P<audio_id>[^,\]]*),[^\]]*\] leaving"), parse_audio_stop)
+        ],
+        'o.b.w.voice.internal.RoomManager': [
+            ('DEBUG o.b.w.voice.internal.RoomManager', 'Joined [', re.compile("Joined \[(?P<audio_id>.*),(?P<user_name>[^,\n]*),[^,\n]*,[^,\n]*"), parse_audio_id)
+        ],
+        'ROOT': [
+            ('DEBUG ROOT', 'Starting up context bigbluebutton', re.compile("Starting up context bigbluebutton"), parse_server_restarted)
+        ]
     }
 
+    ## the counters, also the keys of the datapoint values
     USERS        = 'users_count'
-    USER_JOIN    = 'user_join'
-    USER_LEAVE   = 'user_leave'
-    USER_NAME    = 'user_name'
-
     AUDIO        = 'audio_count'
-    AUDIO_ID     = 'audio_id'
-    AUDIO_START  = 'audio_start'
-    AUDIO_STOP   = 'audio_stop'
-
     VIDEO        = 'video_count'
-    VIDEO_START  = 'video_start'
-    VIDEO_STOP   = 'video_stop'
-    
     ROOM         = 'room_count'
-    ROOM_CREATE  = 'room_create'
-    ROOM_DESTROY = 'room_destroy'
+    SERVER       = 'server'
 
-    SERVER           = 'server'
-    SERVER_RESTARTED = 'server_restarted'
+    ## the event types, which index EventTypeMap and EventTypeNames
+    USER_JOIN    = 0
+    USER_LEAVE   = 1
+    USER_NAME    = 2
 
-    EventTypeMap = {
-        USER_JOIN: USERS,
-        USER_LEAVE: USERS,
-        USER_NAME: USERS,
+    AUDIO_ID     = 3
+    AUDIO_START  = 4
+    AUDIO_STOP   = 5
 
-        AUDIO_START: AUDIO,
-        AUDIO_STOP: AUDIO,
-        AUDIO_ID: AUDIO,
+    VIDEO_START  = 6
+    VIDEO_STOP   = 7
 
-        VIDEO_START: VIDEO,
-        VIDEO_STOP: VIDEO,
+    ROOM_CREATE  = 8
+    ROOM_DESTROY = 9
 
-        ROOM_CREATE: ROOM,
-        ROOM_DESTROY: ROOM,
-        
-        SERVER_RESTARTED: SERVER
-    }
+    SERVER_RESTARTED = 10
 
-    EventTypeNames = {
-        USER_JOIN: 'USER_JOIN',
-        USER_LEAVE: 'USER_LEAVE',
-        USER_NAME: 'USER_NAME',
-        AUDIO_START: 'AUDIO_START',
-        AUDIO_STOP: 'AUDIO_STOP',
-        AUDIO_ID: 'AUDIO_ID',
-        VIDEO_START: 'VIDEO_START',
-        VIDEO_STOP: 'VIDEO_STOP',
-        ROOM_CREATE: 'ROOM_CREATE',
-        ROOM_DESTROY: 'ROOM_DESTROY',
-        SERVER_RESTARTED: 'SERVER_RESTARTED'
-    }
+    EventTypeMap = [
+        USERS,    # USER_JOIN
+        USERS,    # USER_LEAVE
+        USERS,    # USER_NAME
+
+        AUDIO,    # AUDIO_ID
+        AUDIO,    # AUDIO_START
+        AUDIO,    # AUDIO_STOP
+
+        VIDEO,    # VIDEO_START
+        VIDEO,    # VIDEO_STOP
+
+        ROOM,     # ROOM_CREATE
+        ROOM,     # ROOM_DESTROY
+
+        SERVER    # SERVER_RESTARTED
+    ]
+
+    EventTypeNames = [
+        'USER_JOIN',
+        'USER_LEAVE',
+        'USER_NAME',
+        'AUDIO_ID',
+        'AUDIO_START',
+        'AUDIO_STOP',
+        'VIDEO_START',
+        'VIDEO_STOP',
+        'ROOM_CREATE',
+        'ROOM_DESTROY',
+        'SERVER_RESTARTED'
+    ]
 
     def __init__(self, line):
-        tokens = line.split(" ",2)
-        datetime = " ".join(tokens[0:2]).replace(',','.')
-        self.__timestamp__ = calendar.timegm(dateutil.parser.parse(datetime).timetuple())
+        self.__timestamp__ = parse_timestamp(line)
+        self.__millis__ = parse_millis(line)
         self.__line__ = line
+        self.__user_id__ = self.__username__ = self.__room_id__ = self.__audio_id__ = None
+
+    def __getstate__(self):
+        ## slots have no __dict__ to pickle (events are sent between processes)
+        return tuple([getattr(self, name) for name in LogLineEvent.__slots__])
+
+    def record(self):
+        """
+        the fields of the event as a tuple: timestamp, type, user_id, username,
+        room_id and audio_id
+        """
+        return (self.__timestamp__, self.__type__, self.__user_id__, self.__username__,
+            self.__room_id__, self.__audio_id__)
+
+    @staticmethod
+    def from_record(record):
+        """
+        the event for a tuple given by record(), without its line
+        """
+        event = LogLineEvent.__new__(LogLineEvent)
+        event.__timestamp__, event.__type__, event.__user_id__, event.__username__, \
+            event.__room_id__, event.__audio_id__ = record
+        event.__millis__ = 0
+        event.__line__ = None
+        return event
+
+    def __setstate__(self, state):
+        for name, value in zip(LogLineEvent.__slots__, state):
+            setattr(self, name, value)
 
     def __str__(self):
         return LogLineEvent.EventTypeNames[self.__type__]
@@ -198,6 +359,10 @@ class LogLineEvent:
     def timestamp(self):
         return self.__timestamp__
 
+    def millis(self):
+        ## only used to order events of the same second from different logs
+        return self.__millis__
+
     def username(self):
         return self.__username__
         
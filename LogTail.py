@@ -0,0 +1,163 @@
+import os
+import json
+import datetime
+
+class LogTail:
+    """
+    LogTail follows a log file across runs. It keeps a checkpoint file with the
+    inode, device and byte offset of the log (plus any partial trailing line),
+    so each run only reads the bytes appended since the previous one. Rotation
+    (the log got a new inode) and truncation (the log shrank) are detected on
+    startup; in the first case the remainder of the rotated file is read before
+    the new one.
+    """
+
+    CHUNK_SIZE = 65536
+
+    ## lines older than this (relative to now) are never held back on commit
+    HOLD_BACK_SECONDS = 3600
+
+    def __init__(self, filename, checkpoint):
+        self.__filename__ = filename
+        self.__checkpoint__ = checkpoint
+        self.__state__ = self.__readCheckpoint__()
+        ## (timestamp prefix, inode, device, offset) of the first line of each
+        ## recent second read so far; used to rewind on commit
+        self.__marks__ = []
+
+    def __readCheckpoint__(self):
+        state = {'inode': None, 'device': None, 'offset': 0, 'partial': ''}
+        try:
+            f = open(self.__checkpoint__, 'r')
+            state.update(json.loads(f.read()))
+            f.close()
+        except (IOError, ValueError):
+            pass
+        ## the partial line is kept as latin-1, which maps each byte to a
+        ## character, so any bytes in the log go through JSON unchanged
+        state['partial'] = state['partial'].encode('latin-1')
+        return state
+
+    def __writeCheckpoint__(self, state):
+        tmpname = self.__checkpoint__ + '.tmp'
+        f = open(tmpname, 'w')
+        f.write(json.dumps(dict(state, partial=state['partial'].decode('latin-1'))) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmpname, self.__checkpoint__)
+
+    def __rotated__(self, inode, device):
+        """
+        looks for the rotated copy of the log that still carries the inode
+        we were reading from
+        """
+        candidate = self.__filename__ + '.1'
+        try:
+            st = os.stat(candidate)
+        except OSError:
+            return None
+        if st.st_ino == inode and st.st_dev == device:
+            return candidate
+        return None
+
+    def __sources__(self):
+        """
+        returns the list of (filename, offset, partial) to read, in order
+        """
+        state = self.__state__
+        try:
+            st = os.stat(self.__filename__)
+        except OSError:
+            return []
+
+        if state['inode'] is None:
+            # first run, read everything
+            return [(self.__filename__, 0, '')]
+
+        if st.st_ino == state['inode'] and st.st_dev == state['device']:
+            if st.st_size < state['offset']:
+                # the log was truncated in place
+                return [(self.__filename__, 0, '')]
+            return [(self.__filename__, state['offset'], state['partial'])]
+
+        # the log was rotated; finish the old file if we can still find it
+        sources = []
+        rotated = self.__rotated__(state['inode'], state['device'])
+        if rotated:
+            sources.append((rotated, state['offset'], state['partial']))
+        sources.append((self.__filename__, 0, ''))
+        return sources
+
+    def lines(self):
+        """
+        generator with the complete lines appended to the log since the last
+        commit()
+        """
+        cutoff = (datetime.datetime.today() -
+            datetime.timedelta(seconds=LogTail.HOLD_BACK_SECONDS)).strftime('%Y-%m-%d %H:%M:%S')
+        last_prefix = None
+
+        for filename, offset, partial in self.__sources__():
+            try:
+                f = open(filename, 'rb')
+                st = os.fstat(f.fileno())
+                f.seek(offset)
+            except IOError:
+                continue
+
+            buf = partial
+            pos = offset
+            while True:
+                chunk = f.read(LogTail.CHUNK_SIZE)
+                if not chunk: break
+                pos += len(chunk)
+                buf += chunk
+
+                start = 0
+                end = buf.find('\n')
+                while end >= 0:
+                    line = buf[start:end + 1]
+                    prefix = line[:19]
+                    if prefix >= cutoff and prefix != last_prefix and prefix[:2].isdigit():
+                        line_offset = pos - len(buf) + start
+                        self.__marks__.append((prefix, st.st_ino, st.st_dev, line_offset))
+                        last_prefix = prefix
+                    yield line
+                    start = end + 1
+                    end = buf.find('\n', start)
+                buf = buf[start:]
+            f.close()
+
+            self.__state__ = {'inode': st.st_ino, 'device': st.st_dev, 'offset': pos, 'partial': buf}
+
+    def commit(self, watermark=None, rewind=True):
+        """
+        saves the checkpoint. If a watermark (the timestamp of the latest datapoint)
+        is given, lines from that second on are read again on the next run, since
+        their events were not accounted for yet. Without one (no datapoint yet) all
+        the recent lines are read again. With rewind=False only the saved
+        checkpoint goes back to the watermark, and lines() goes on from where it
+        stopped, for callers that keep the events still pending themselves.
+        """
+        state = self.__state__
+        marks = []
+
+        ## with no datapoint, the events read all fall in its first minute, which
+        ## is recent, so going back to the first recent line is enough
+        limit = ''
+        if watermark is not None:
+            limit = datetime.datetime.utcfromtimestamp(watermark).strftime('%Y-%m-%d %H:%M:%S')
+        for number, (prefix, inode, device, offset) in enumerate(self.__marks__):
+            if prefix >= limit:
+                state = {'inode': inode, 'device': device, 'offset': offset, 'partial': ''}
+                marks = self.__marks__[number:]
+                break
+
+        self.__writeCheckpoint__(state)
+        if rewind:
+            self.__state__ = state
+            self.__marks__ = []
+        else:
+            ## the lines after the checkpoint may still have to be rewound to
+            self.__marks__ = marks
@@ -0,0 +1,150 @@
+import os
+import time
+import json
+
+## the label of the counters that are kept per event type, window, etc.
+LABELS = {
+    'events': 'type',
+    'unmatched_events': 'type',
+    'handler_errors': 'type',
+    'datapoints_written': 'window',
+    'responses_written': 'window',
+    'datapoints_archived': 'window',
+    'file_bytes': 'file',
+    'requests': 'status'
+}
+
+class Metrics:
+    """
+    Metrics holds the counters, timers and gauges of a process: how many lines
+    and events were read, how long each stage took, what was written. They only
+    cost a dict update each, so they are always on. summary() gives them as a
+    dict that write() saves as JSON (the data filename + '.metrics' for a run)
+    and prometheus() turns into the text format served on /metrics.
+
+    Counters and gauges can have a label (an event type, a window...), whose
+    name is given by LABELS. Each run of main.py (or cluster.py, backfill.py)
+    has its own Metrics, so write() adds its counters and times to the ones
+    saved by the previous runs, and they keep growing as Prometheus expects.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.seconds = {}
+        ## the summaries in the files written, as they were before the first write
+        self.saved = {}
+
+    def count(self, name, label=None, amount=1):
+        counter = self.counters.setdefault(name, {})
+        counter[label] = counter.get(label, 0) + amount
+
+    def gauge(self, name, label, value):
+        self.gauges.setdefault(name, {})[label] = value
+
+    def add_time(self, stage, seconds):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def elapsed(self, stage):
+        """
+        the seconds spent so far in a stage
+        """
+        return self.seconds.get(stage, 0.0)
+
+    def summary(self):
+        def labeled(values):
+            return dict([(label or '', value) for label, value in values.items()])
+        return {
+            'started': self.started,
+            'updated': time.time(),
+            'counters': dict([(name, labeled(values)) for name, values in self.counters.items()]),
+            'gauges': dict([(name, labeled(values)) for name, values in self.gauges.items()]),
+            'seconds': dict(self.seconds)
+        }
+
+    def write(self, filename):
+        """
+        saves the summary in filename, added to the one it had before this
+        process first wrote it
+        """
+        if filename not in self.saved:
+            self.saved[filename] = read_summary(filename)
+        summary = accumulate(self.saved[filename], self.summary())
+
+        tmpname = filename + '.tmp'
+        f = open(tmpname, 'w')
+        f.write(json.dumps(summary, sort_keys=True) + '\n')
+        f.close()
+        os.rename(tmpname, filename)
+
+def read_summary(filename):
+    """
+    the summary saved by Metrics.write(), or None if there's none
+    """
+    try:
+        f = open(filename, 'r')
+        summary = json.loads(f.read())
+        f.close()
+    except (IOError, ValueError):
+        return None
+    return summary
+
+def accumulate(saved, summary):
+    """
+    summary with the counters and times of saved (an older summary, or None)
+    added to its own; gauges are the ones of summary
+    """
+    if saved is None:
+        return summary
+
+    counters = dict([(name, dict(values)) for name, values in saved['counters'].items()])
+    for name, values in summary['counters'].items():
+        counter = counters.setdefault(name, {})
+        for label, value in values.items():
+            counter[label] = counter.get(label, 0) + value
+
+    seconds = dict(saved['seconds'])
+    for stage, value in summary['seconds'].items():
+        seconds[stage] = seconds.get(stage, 0.0) + value
+
+    return dict(summary, started=min(saved['started'], summary['started']), counters=counters, seconds=seconds)
+
+def prometheus(summaries):
+    """
+    the Prometheus text format for a list of (labels, summary), where labels is
+    a dict of labels to add to all the values of the summary (such as the server)
+    """
+    samples = {}
+    def add(metric, kind, labels, value):
+        text = ','.join(['%s="%s"' % (key, str(labels[key]).replace('\\', '\\\\').replace('"', '\\"'))
+            for key in sorted(labels)])
+        samples.setdefault((metric, kind), []).append('%s{%s} %s' % (metric, text, repr(float(value))))
+
+    for labels, summary in summaries:
+        for name, values in summary['counters'].items():
+            for label, value in values.items():
+                add('mconf_%s_total' % name, 'counter', with_label(labels, name, label), value)
+        for name, values in summary['gauges'].items():
+            for label, value in values.items():
+                add('mconf_%s' % name, 'gauge', with_label(labels, name, label), value)
+        for stage, value in summary['seconds'].items():
+            add('mconf_stage_seconds_total', 'counter', dict(labels, stage=stage), value)
+        add('mconf_last_update_timestamp_seconds', 'gauge', labels, summary['updated'])
+
+    lines = []
+    for metric, kind in sorted(samples):
+        lines.append('# TYPE %s %s' % (metric, kind))
+        lines.extend(sorted(samples[(metric, kind)]))
+    return '\n'.join(lines) + '\n'
+
+def with_label(labels, name, label):
+    if not label:
+        return labels
+    return dict(labels, **{LABELS.get(name, 'label'): label})
+
+## the metrics of this process
+metrics = Metrics()
@@ -0,0 +1,199 @@
+import os
+import mmap
+import json
+import struct
+
+NAN = float('nan')
+
+def is_ring(filename):
+    """
+    tells whether filename is a RingStore file (as opposed to a JSON one)
+    """
+    try:
+        f = open(filename, 'rb')
+        magic = f.read(len(RingStore.MAGIC))
+        f.close()
+    except IOError:
+        return False
+    return magic == RingStore.MAGIC
+
+class RingStore:
+    """
+    RingStore is a binary storage for the StatTable windows, in the spirit of RRDtool.
+    The whole file is mmap'ed and has a fixed size:
+        header:   magic, version and the layout as JSON (for each window its name,
+                  size, value keys and the offset of its records), padded to HEADER_SIZE
+        counters: one uint64 per window, the number of records ever written to it
+        records:  for each window, 'size' fixed-width records (idx, timestamp and
+                  one double per value key, NaN where the datapoint has no such
+                  value), record n being stored at slot n % size
+
+    Writing a datapoint changes a few dozen bytes in place, and readers can map the
+    file read-only and unpack just the window they need.
+    """
+
+    MAGIC = 'MCSTRING'
+    VERSION = 1
+    EXTENSION = '.ring'
+
+    HEADER_SIZE = 4096
+    HEADER_FORMAT = '<8sII'
+
+    def __init__(self, filename, layout=None, readonly=False):
+        """
+        opens the store at filename. layout is a list of (name, size, keys) for each
+        window; if the file doesn't exist yet it's created with this layout, and if it
+        exists with a different one, its data is migrated to the new layout.
+        """
+        self.__filename__ = filename
+        self.__readonly__ = readonly
+
+        if not is_ring(filename):
+            if readonly or layout is None:
+                raise IOError('%s is not a ring file' % filename)
+            self.__create__(layout)
+
+        self.__open__()
+
+        if layout is not None and not readonly and self.__layout__() != self.__normalize__(layout):
+            data = self.read()
+            self.close()
+            self.__create__(layout)
+            self.__open__()
+            self.write(data)
+
+    def __normalize__(self, layout):
+        return [(str(name), int(size), [str(key) for key in keys]) for name, size, keys in layout]
+
+    def __layout__(self):
+        return [(str(w['name']), w['size'], [str(key) for key in w['keys']]) for w in self.__windows__]
+
+    def __create__(self, layout):
+        windows = []
+        offset = RingStore.HEADER_SIZE + 8 * len(layout)
+        for name, size, keys in self.__normalize__(layout):
+            windows.append({'name': name, 'size': size, 'keys': keys, 'offset': offset})
+            offset += size * struct.calcsize(self.__recordFormat__(keys))
+
+        header = json.dumps({'windows': windows})
+        if struct.calcsize(RingStore.HEADER_FORMAT) + len(header) > RingStore.HEADER_SIZE:
+            raise ValueError('layout too large for the ring header')
+
+        ## the file is built aside and renamed, so readers never see half of it
+        tmpname = self.__filename__ + '.tmp'
+        f = open(tmpname, 'wb')
+        f.write(struct.pack(RingStore.HEADER_FORMAT, RingStore.MAGIC, RingStore.VERSION, len(header)))
+        f.write(header)
+        f.truncate(offset)
+        f.close()
+        os.rename(tmpname, self.__filename__)
+
+    def __open__(self):
+        self.__file__ = open(self.__filename__, 'rb' if self.__readonly__ else 'r+b')
+        access = mmap.ACCESS_READ if self.__readonly__ else mmap.ACCESS_WRITE
+        self.__map__ = mmap.mmap(self.__file__.fileno(), 0, access=access)
+
+        magic, version, length = struct.unpack_from(RingStore.HEADER_FORMAT, self.__map__, 0)
+        if version != RingStore.VERSION:
+            raise IOError('unsupported ring file version %d' % version)
+        start = struct.calcsize(RingStore.HEADER_FORMAT)
+        self.__windows__ = json.loads(self.__map__[start:start + length])['windows']
+        for number, window in enumerate(self.__windows__):
+            window['counter'] = RingStore.HEADER_SIZE + 8 * number
+            window['format'] = self.__recordFormat__(window['keys'])
+            window['width'] = struct.calcsize(window['format'])
+
+    def __recordFormat__(self, keys):
+        ## idx, timestamp and the values
+        return '<qd' + 'd' * len(keys)
+
+    def __window__(self, name):
+        for window in self.__windows__:
+            if window['name'] == name:
+                return window
+        raise KeyError(name)
+
+    def __count__(self, window):
+        return struct.unpack_from('<Q', self.__map__, window['counter'])[0]
+
+    def __number__(self, value):
+        ## values are stored as doubles; give back ints where they were ints
+        if value == int(value):
+            return int(value)
+        return value
+
+    def close(self):
+        self.__map__.close()
+        self.__file__.close()
+
+    def counts(self):
+        """
+        the number of records written to each window so far; it changes whenever
+        the store does
+        """
+        return [self.__count__(window) for window in self.__windows__]
+
+    def windows(self):
+        return [window['name'] for window in self.__windows__]
+
+    def datapoints(self, name):
+        """
+        the datapoints of one window, oldest first
+        """
+        window = self.__window__(name)
+        count = self.__count__(window)
+        size = window['size']
+
+        result = []
+        for number in xrange(max(count - size, 0), count):
+            record = struct.unpack_from(window['format'], self.__map__,
+                window['offset'] + (number % size) * window['width'])
+            ## NaN (the only value not equal to itself) is a value the datapoint didn't have
+            value = dict([(key, self.__number__(v)) for key, v in zip(window['keys'], record[2:]) if v == v])
+            result.append({'idx': record[0], 'timestamp': self.__number__(record[1]), 'value': value})
+        return result
+
+    def read(self):
+        """
+        all windows, in the same format StatTable keeps in memory
+        """
+        return dict([(name, {'datapoints': self.datapoints(name)}) for name in self.windows()])
+
+    def write(self, data):
+        """
+        stores the datapoints of data that are newer than the ones already in the file
+        """
+        for window in self.__windows__:
+            if not data.has_key(window['name']): continue
+            count = self.__count__(window)
+            size = window['size']
+
+            last_idx = None
+            if count > 0:
+                record = struct.unpack_from('<q', self.__map__,
+                    window['offset'] + ((count - 1) % size) * window['width'])
+                last_idx = record[0]
+
+            datapoints = data[window['name']]['datapoints']
+            new = [d for d in datapoints[-size:] if last_idx is None or d['idx'] > last_idx]
+            for datapoint in new:
+                values = [float(datapoint['value'].get(key, NAN)) for key in window['keys']]
+                struct.pack_into(window['format'], self.__map__,
+                    window['offset'] + (count % size) * window['width'],
+                    datapoint['idx'], float(datapoint['timestamp']), *values)
+                count += 1
+
+            ## the counter goes last, so a reader never sees a slot not written yet
+            struct.pack_into('<Q', self.__map__, window['counter'], count)
+
+        self.__map__.flush()
+
+    def replace(self, data):
+        """
+        stores data in place of everything in the file, for when datapoints
+        were dropped rather than added
+        """
+        for window in self.__windows__:
+            if data.has_key(window['name']):
+                struct.pack_into('<Q', self.__map__, window['counter'], 0)
+        self.write(data)
@@ -0,0 +1,55 @@
+from array import array
+
+## NumPy is optional; without it the same statistics are computed on plain arrays
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+## the statistics computed for each frame, besides the maximum
+STATISTICS = ['min', 'mean', 'p95']
+
+def percentile(ordered, fraction):
+    """
+    percentile of an already sorted sequence, interpolating linearly between
+    the closest ranks (the same method as numpy.percentile)
+    """
+    rank = fraction * (len(ordered) - 1)
+    low = int(rank)
+    if low + 1 >= len(ordered):
+        return float(ordered[low])
+    return ordered[low] + (ordered[low + 1] - ordered[low]) * (rank - low)
+
+def rollup(values, frame_size):
+    """
+    splits values into consecutive frames of frame_size values (an incomplete last
+    frame is ignored) and returns, for each statistic ('max' and STATISTICS), the
+    list with its value for each frame
+    """
+    n_frames = len(values) / frame_size
+    if n_frames == 0:
+        return dict([(stat, []) for stat in ['max'] + STATISTICS])
+
+    if numpy is not None:
+        frames = numpy.asarray(values[:n_frames * frame_size]).reshape(n_frames, frame_size)
+        return {
+            'max':  frames.max(axis=1).tolist(),
+            'min':  frames.min(axis=1).tolist(),
+            'mean': frames.mean(axis=1).tolist(),
+            'p95':  numpy.percentile(frames, 95, axis=1).tolist()
+        }
+
+    result = dict([(stat, []) for stat in ['max'] + STATISTICS])
+    for frame_idx in xrange(n_frames):
+        frame = sorted(values[frame_idx * frame_size: (frame_idx + 1) * frame_size])
+        result['max'].append(frame[-1])
+        result['min'].append(frame[0])
+        result['mean'].append(float(sum(frame)) / frame_size)
+        result['p95'].append(percentile(frame, 0.95))
+    return result
+
+def column(datapoints, metric):
+    """
+    the values of one metric over the datapoints, as a compact array
+    """
+    return array('l', [datapoint['value'][metric] for datapoint in datapoints])
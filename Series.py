@@ -0,0 +1,62 @@
+import bisect
+
+def transpose(obj):
+    """
+    turns the datapoints of a window into one [timestamp, value] series per metric;
+    datapoints older than a metric are left out of its series
+    """
+    output = {}
+    if len(obj['datapoints']) == 0:
+        return output
+
+    # we take the newest datapoint as a template for all others, so metrics
+    # added since the oldest one show up too
+    keys = obj['datapoints'][-1]['value'].keys()
+    for key in keys:
+        output[key] = []
+        for datapoint in obj['datapoints']:
+            if datapoint['value'].has_key(key):
+                output[key].append([datapoint['timestamp'], datapoint['value'][key]])
+    return output
+
+def time_range(datapoints, timestamps, start=None, end=None):
+    """
+    the datapoints with start <= timestamp <= end; timestamps is the sorted list of
+    the datapoints' timestamps, so the range is found by binary search
+    """
+    first = 0
+    last = len(datapoints)
+    if start is not None:
+        first = bisect.bisect_left(timestamps, start)
+    if end is not None:
+        last = bisect.bisect_right(timestamps, end)
+    return datapoints[first:last]
+
+def downsample(datapoints, max_points):
+    """
+    reduces the datapoints to at most max_points, splitting them into that many
+    consecutive buckets. Each value keeps the maximum over its bucket, so peaks are
+    never lost, except the rollup statistics ending in '_min' and '_mean', which keep
+    the minimum and the average. Each bucket takes the timestamp and idx of its last
+    datapoint, like the rollups in StatTable
+    """
+    if max_points <= 0 or len(datapoints) <= max_points:
+        return datapoints
+
+    result = []
+    for bucket_idx in xrange(max_points):
+        bucket = datapoints[bucket_idx * len(datapoints) / max_points:
+            (bucket_idx + 1) * len(datapoints) / max_points]
+
+        value = {}
+        for key in bucket[-1]['value']:
+            values = [datapoint['value'][key] for datapoint in bucket if datapoint['value'].has_key(key)]
+            if key.endswith('_min'):
+                value[key] = min(values)
+            elif key.endswith('_mean'):
+                value[key] = float(sum(values)) / len(values)
+            else:
+                value[key] = max(values)
+
+        result.append({'timestamp': bucket[-1]['timestamp'], 'value': value, 'idx': bucket[-1]['idx']})
+    return result
@@ -0,0 +1,121 @@
+from collections import OrderedDict
+
+class SessionState:
+    """
+    SessionState holds the users currently connected to the server. self.users is
+    the dict that gets saved to the session checkpoint, in joining order (user id ->
+    {'audio', 'video', 'username', 'audio_id', 'room_id'}); on top of it, SessionState
+    keeps secondary indexes so the audio and room events don't need to scan every user:
+        username -> users still waiting for their audio id
+        username -> users with an audio id, waiting for the audio to start
+        audio_id -> users with audio on
+        room_id  -> users in the room
+
+    Users must only be changed through join(), leave() and update(), so the
+    indexes are kept up to date. When several users match a lookup (users with
+    the same name), the one that joined first is returned.
+    """
+
+    def __init__(self, users=None):
+        if users is None:
+            users = OrderedDict()
+        self.users = users
+
+        self.__awaiting_id__ = {}
+        self.__awaiting_start__ = {}
+        self.__by_audio_id__ = {}
+        self.__by_room__ = {}
+
+        ## joining order of each user, used to break ties between users
+        self.__joined__ = {}
+        self.__joins__ = 0
+
+        for user_id in self.users:
+            self.__joined__[user_id] = self.__joins__
+            self.__joins__ += 1
+            self.__index__(user_id)
+
+    def __indexes__(self, user):
+        ## the (index, key) pairs a user belongs to, given its current state
+        result = [(self.__by_room__, user['room_id'])]
+        if user['audio']:
+            result.append((self.__by_audio_id__, user['audio_id']))
+        elif user['audio_id'] == 0:
+            result.append((self.__awaiting_id__, user['username']))
+        else:
+            result.append((self.__awaiting_start__, user['username']))
+        return result
+
+    def __index__(self, user_id):
+        for index, key in self.__indexes__(self.users[user_id]):
+            index.setdefault(key, {})[user_id] = self.__joined__[user_id]
+
+    def __unindex__(self, user_id):
+        for index, key in self.__indexes__(self.users[user_id]):
+            bucket = index[key]
+            del bucket[user_id]
+            if not bucket: del index[key]
+
+    def __any__(self, index, key):
+        bucket = index.get(key)
+        if not bucket: return None
+        if len(bucket) == 1:
+            for user_id in bucket: return user_id
+        return min(bucket, key=bucket.get)
+
+    def __contains__(self, user_id):
+        return user_id in self.users
+
+    def __getitem__(self, user_id):
+        return self.users[user_id]
+
+    def join(self, user_id):
+        """
+        adds a new user (replacing any user with the same id)
+        """
+        if user_id in self.users:
+            self.leave(user_id)
+        self.users[user_id] = { 'audio': False, 'video': False, 'username': '', 'audio_id': 0, 'room_id': '' }
+        self.__joined__[user_id] = self.__joins__
+        self.__joins__ += 1
+        self.__index__(user_id)
+
+    def leave(self, user_id):
+        """
+        removes the user and returns its state; raises KeyError for unknown users
+        """
+        self.__unindex__(user_id)
+        del self.__joined__[user_id]
+        return self.users.pop(user_id)
+
+    def update(self, user_id, **fields):
+        """
+        changes some fields of the user; raises KeyError for unknown users
+        """
+        self.__unindex__(user_id)
+        self.users[user_id].update(fields)
+        self.__index__(user_id)
+
+    def awaiting_audio_id(self, username):
+        """
+        a user with this name, without audio and without an audio id, or None
+        """
+        return self.__any__(self.__awaiting_id__, username)
+
+    def awaiting_audio_start(self, username):
+        """
+        a user with this name, without audio but with an audio id, or None
+        """
+        return self.__any__(self.__awaiting_start__, username)
+
+    def with_audio(self, audio_id):
+        """
+        the user with audio on under this audio id, or None
+        """
+        return self.__any__(self.__by_audio_id__, audio_id)
+
+    def in_room(self, room_id):
+        """
+        the ids of all users in the room
+        """
+        return list(self.__by_room__.get(room_id, ()))
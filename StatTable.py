@@ -3,10 +3,149 @@ import os
 import json
 import datetime
 import calendar
-import sys
+import fcntl
+import bisect
+from collections import OrderedDict
 
 import Constants
 from LogLineEvent import LogLineEvent
+from SessionState import SessionState
+from RingStore import RingStore, is_ring
+import Rollup
+import Series
+import Deflate
+from Metrics import metrics
+from EventArchive import EventArchive
+from History import History
+
+def read_data(filename, windows=None):
+    """
+    reads the data written by a StatTable, in either storage format, without
+    changing anything; windows optionally restricts which windows are read
+    """
+    if windows is None:
+        windows = ['daily', 'weekly', 'monthly', 'annually']
+
+    if is_ring(filename):
+        store = RingStore(filename, readonly=True)
+        obj = dict([(key, {'datapoints': store.datapoints(key)}) for key in windows])
+        store.close()
+        return obj
+
+    obj, entries, complete = read_journaled(filename)
+    return dict([(key, obj[key]) for key in windows])
+
+def data_version(filename):
+    """
+    a cheap value that changes whenever the data written by a StatTable does,
+    without reading the data itself
+    """
+    version = []
+    for name in [filename, filename + '.journal']:
+        try:
+            st = os.stat(name)
+            version.append((st.st_mtime, st.st_size))
+        except OSError:
+            version.append(None)
+
+    ## writes through mmap don't reliably update the mtime
+    if is_ring(filename):
+        store = RingStore(filename, readonly=True)
+        version.append(tuple(store.counts()))
+        store.close()
+
+    return tuple(version)
+
+def response_filename(filename, window, deflated=False):
+    """
+    the file with the /stats/ response for a window (or 'all') of filename, as
+    written by StatTable on each update; with deflated, the one with it already
+    compressed (see Deflate.precompress())
+    """
+    return '%s.%s.json%s' % (filename, window, '.deflate' if deflated else '')
+
+def read_journaled(filename):
+    """
+    reads a JSON data file: the snapshot in filename plus the datapoints appended
+    to its journal (filename + '.journal') since the snapshot was written. Returns
+    the data, the number of entries in the journal and whether the journal ended
+    cleanly (it doesn't if the last write was interrupted)
+    """
+    # default object for empty files
+    obj = {
+        'daily'  : {'datapoints': []},
+        'weekly' : {'datapoints': []},
+        'monthly': {'datapoints': []},
+        'annually': {'datapoints': []}
+    }
+
+    f = open(filename, 'r')
+    filestring = f.read()
+    f.close()
+    ## a snapshot that doesn't parse is an error; starting from an empty
+    ## table would overwrite the whole history
+    if filestring.strip():
+        obj = json.loads(filestring)
+
+    entries = 0
+    complete = True
+    try:
+        journal = open(filename + '.journal', 'r')
+    except IOError:
+        journal = []
+
+    for line in journal:
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # the last write was interrupted
+            complete = False
+            break
+        entries += 1
+
+        ## entries already in the snapshot are skipped, in case we stopped
+        ## between writing a snapshot and emptying the journal
+        datapoints = obj[entry['window']]['datapoints']
+        if len(datapoints) == 0 or entry['datapoint']['idx'] > datapoints[-1]['idx']:
+            datapoints.append(entry['datapoint'])
+
+    for key in ['daily', 'weekly', 'monthly', 'annually']:
+        obj[key]['datapoints'] = obj[key]['datapoints'][-StatTable.STAT_TABLE_SIZES[key]:]
+
+    return obj, entries, complete
+
+def acquire_lock(filename):
+    """
+    takes an exclusive lock for the data file (on filename + '.lock'), so runs
+    that overlap never update it at the same time. Returns the lock, which must
+    be kept open while updating, or None if another process holds it
+    """
+    f = open(filename + '.lock', 'a')
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        f.close()
+        return None
+    return f
+
+def read_manifest(filename):
+    """
+    reads a cluster manifest: one server per line, with its name, its latest
+    bigbluebutton log file and its data file, separated by blanks. Empty lines
+    and lines starting with '#' are ignored. Returns the list of (name, logfile,
+    datafile), in the order of the file
+    """
+    servers = []
+    f = open(filename, 'r')
+    for line in f:
+        line = line.strip()
+        if len(line) == 0 or line.startswith('#'): continue
+        fields = line.split()
+        if len(fields) != 3:
+            raise ValueError('bad manifest line: %s' % line)
+        servers.append(tuple(fields))
+    f.close()
+    return servers
     
 class StatTable:
     """
@@ -14,6 +153,24 @@ class StatTable:
     for important bigbluebutton events. The main method is update(events), which loads
     the current table from file (a json-encoded file) and adds the events that haven't been
     accounted for yet, doing proper aggregation.
+
+    New datapoints are appended to a journal (the data filename + '.journal'), and
+    the JSON file itself is only rewritten, atomically, once the journal gets long.
+    Data files ending in '.ring' (or already in that format) are kept in a RingStore
+    instead, a fixed-size binary file updated in place.
+
+    The datapoints only hold the counters. The state of the connected users, needed
+    to resume from the latest datapoint, is kept apart in a small checkpoint file
+    (the data filename + '.session') that is replaced on every update, before the
+    datapoints are written. It also keeps the state of the previous update, so
+    the data can be resumed whether or not its write got to the disk. The events
+    accounted for are kept in an EventArchive (the data filename + '.events'),
+    unless the table is created with archive=False. The datapoints slid out of the
+    windows are kept in a History (the data filename + '.history').
+
+    The web server answers requests for whole windows with files written here
+    (see response_filename()), as they are and already compressed, which are
+    replaced whenever their window gets new datapoints.
     """
 
     STAT_TABLE_SIZES = {
@@ -30,55 +187,214 @@ class StatTable:
         'annually': 360
         }
 
-    def __init__(self, filename):
-        self.__filename__ = filename
+    STAT_METRICS = [LogLineEvent.USERS, LogLineEvent.AUDIO, LogLineEvent.VIDEO, LogLineEvent.ROOM]
 
-        cmd = 'touch ' + self.__filename__
-        os.system(cmd)
+    ## journal entries (datapoints) after which the JSON file is compacted
+    JOURNAL_COMPACT_SIZE = 1440
 
+    def __init__(self, filename, archive=True):
+        self.__filename__ = filename
+        self.__journalfile__ = self.__filename__ + '.journal'
+        self.__journaled__ = 0
+        self.__compact__ = False
+
+        self.__ring__ = None
+        if self.__filename__.endswith(RingStore.EXTENSION) or is_ring(self.__filename__):
+            self.__ring__ = RingStore(self.__filename__, StatTable.layout())
+        else:
+            cmd = 'touch ' + self.__filename__
+            os.system(cmd)
+
+        start = time.time()
         self.__data__ = self.__readFile__()
+        self.__sessionfile__ = self.__filename__ + '.session'
+        self.__session__ = self.__readSession__()
+        self.__persisted__ = dict([(key, self.__lastIdx__(key)) for key in self.__data__])
+        metrics.add_time('read', time.time() - start)
+
+        self.__archive__ = None
+        if archive:
+            self.__archive__ = EventArchive(self.__filename__ + '.events')
+        self.__history__ = History(self.__filename__ + '.history')
+
+    @staticmethod
+    def layout():
+        """
+        the (window, size, value keys) of each window, as used by RingStore
+        """
+        rollup_keys = StatTable.STAT_METRICS + [metric + '_' + statistic
+            for metric in StatTable.STAT_METRICS for statistic in Rollup.STATISTICS]
+        return [('daily', StatTable.STAT_TABLE_SIZES['daily'], StatTable.STAT_METRICS)] + \
+            [(key, StatTable.STAT_TABLE_SIZES[key], rollup_keys) for key in ['weekly', 'monthly', 'annually']]
+
+    def __lastIdx__(self, key):
+        datapoints = self.__data__[key]['datapoints']
+        if len(datapoints) == 0: return None
+        return datapoints[-1]['idx']
 
     def __writeFile__(self):
-        # writes the data as a JSON-encoded dict
-        f = open(self.__filename__, 'w')
+        for key in ['daily', 'weekly', 'monthly', 'annually']:
+            persisted = self.__persisted__[key]
+            new = len([datapoint for datapoint in self.__data__[key]['datapoints']
+                if persisted is None or datapoint['idx'] > persisted])
+            metrics.count('datapoints_written', key, new)
+
+        if self.__ring__ is not None:
+            # only the new datapoints are written, in place
+            self.__ring__.write(self.__data__)
+            for key in self.__data__:
+                self.__persisted__[key] = self.__lastIdx__(key)
+            return
+
+        if self.__compact__ or self.__journaled__ >= StatTable.JOURNAL_COMPACT_SIZE:
+            self.__compactFile__()
+            return
+
+        # appends the datapoints not persisted yet to the journal, one JSON
+        # entry per line, with a single fsync for all of them
+        lines = []
+        for key in ['daily', 'weekly', 'monthly', 'annually']:
+            persisted = self.__persisted__[key]
+            new = []
+            for datapoint in reversed(self.__data__[key]['datapoints']):
+                if persisted is not None and datapoint['idx'] <= persisted: break
+                new.append(datapoint)
+            for datapoint in reversed(new):
+                lines.append(json.dumps({'window': key, 'datapoint': datapoint}) + '\n')
+            self.__persisted__[key] = self.__lastIdx__(key)
+
+        if len(lines) == 0: return
+
+        f = open(self.__journalfile__, 'a')
+        f.write(''.join(lines))
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        self.__journaled__ += len(lines)
+
+    def __compactFile__(self):
+        # writes the data as a JSON-encoded dict to a temporary file, which then
+        # replaces the data file; only then the journal can be emptied
+        tmpname = self.__filename__ + '.tmp'
+        f = open(tmpname, 'w')
 
         filestring = json.dumps(self.__data__) + '\n'
         f.write(filestring)
+        f.flush()
+        os.fsync(f.fileno())
         f.close()
+        os.rename(tmpname, self.__filename__)
+
+        open(self.__journalfile__, 'w').close()
+        self.__journaled__ = 0
+        self.__compact__ = False
+        for key in self.__data__:
+            self.__persisted__[key] = self.__lastIdx__(key)
 
     def __readFile__(self):
-        # reads a JSON-encoded object from file
-        f = open(self.__filename__, 'r')
-
-        # default object for empty files
-        obj = {
-            'daily'  : {'datapoints': []},
-            'weekly' : {'datapoints': []},
-            'monthly': {'datapoints': []},
-            'annually': {'datapoints': []}
-        }
+        if self.__ring__ is not None:
+            return self.__ring__.read()
+
+        # reads the snapshot and replays the journal; if its end is damaged, the
+        # next write compacts it, since nothing can be appended after it
+        obj, self.__journaled__, complete = read_journaled(self.__filename__)
+        if not complete:
+            self.__compact__ = True
+        return obj
 
-        try:
-            obj = json.loads(f.read())
-        except ValueError as err:
-            pass
+    def __readSession__(self):
+        # reads the session state saved along with the latest datapoint
+        daily = self.__data__['daily']['datapoints']
+        state = {'idx': -1, 'users': OrderedDict()}
+        self.__previous__ = None
 
+        try:
+            f = open(self.__sessionfile__, 'r')
+            state = json.loads(f.read(), object_pairs_hook=OrderedDict)
+            f.close()
+        except (IOError, ValueError):
+            ## data files from older versions kept the users in each datapoint
+            if len(daily) > 0 and daily[-1]['value'].has_key('users'):
+                state = {'idx': daily[-1]['idx'], 'users': OrderedDict(daily[-1]['value']['users'])}
+
+        ## drop the users from datapoints in the old format
+        for key in ['daily', 'weekly', 'monthly', 'annually']:
+            for datapoint in self.__data__[key]['datapoints']:
+                if datapoint['value'].pop('users', None) is not None:
+                    self.__compact__ = True
+
+        ## the session is written before the datapoints, so if we stopped in
+        ## between, the data is still at the previous state; if its write was
+        ## cut short (or came first, in older versions), the datapoints after the
+        ## state are dropped: the tail wasn't committed, their events come again
+        if len(daily) > 0 and state['idx'] != daily[-1]['idx']:
+            previous = state.get('previous')
+            if state['idx'] > daily[-1]['idx'] and previous is not None:
+                state = previous
+            if state['idx'] < daily[-1]['idx'] and state['idx'] in [datapoint['idx'] for datapoint in daily]:
+                self.__truncate__(state['idx'])
+            if state['idx'] != daily[-1]['idx']:
+                print "Session state is from datapoint %d, but the latest one is %d" % (state['idx'], daily[-1]['idx'])
+
+        state.pop('previous', None)
+        if len(daily) > 0 and state['idx'] == daily[-1]['idx']:
+            ## a copy, the users keep changing in place
+            self.__previous__ = json.loads(json.dumps(state), object_pairs_hook=OrderedDict)
+        return SessionState(state['users'])
+
+    def __truncate__(self, idx):
+        # drops the datapoints after idx, in memory and in the file
+        print "Dropping the datapoints after %d, which have no session state" % idx
+        for key in self.__data__:
+            self.__data__[key]['datapoints'] = [datapoint
+                for datapoint in self.__data__[key]['datapoints'] if datapoint['idx'] <= idx]
+        if self.__ring__ is not None:
+            self.__ring__.replace(self.__data__)
+        else:
+            self.__compact__ = True
+
+    def __writeSession__(self):
+        # writes the session state of the latest datapoint, atomically
+        daily = self.__data__['daily']['datapoints']
+        if len(daily) == 0: return
+
+        state = {'idx': daily[-1]['idx'], 'users': self.__session__.users}
+        if self.__previous__ is not None and self.__previous__['idx'] == state['idx']: return
+
+        tmpname = self.__sessionfile__ + '.tmp'
+        f = open(tmpname, 'w')
+        f.write(json.dumps(dict(state, previous=self.__previous__)) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
         f.close()
+        os.rename(tmpname, self.__sessionfile__)
 
-        return obj
+        ## a copy, the users keep changing in place
+        self.__previous__ = json.loads(json.dumps(state), object_pairs_hook=OrderedDict)
 
     def datapoints(self):
         return self.__datapoints__
 
+    def latest(self):
+        """
+        timestamp of the latest daily datapoint, or None if there's no data yet
+        """
+        if len(self.__data__['daily']['datapoints']) == 0:
+            return None
+        return self.__data__['daily']['datapoints'][-1]['timestamp']
+
     def __slideWindow__(self):
         """
         reads the files and deletes excessive lines from the start,
-        to maintain the max allowable period size for each file
+        to maintain the max allowable period size for each file;
+        the deleted ones go to the history
         """
         for key in ['daily', 'weekly', 'monthly', 'annually']:
             if len(self.__data__[key]['datapoints']) > StatTable.STAT_TABLE_SIZES[key]:
+                trimmed = len(self.__data__[key]['datapoints']) - StatTable.STAT_TABLE_SIZES[key]
+                self.__history__.write(key, self.__data__[key]['datapoints'][:trimmed])
                 self.__data__[key]['datapoints'] =\
-                    self.__data__[key]['datapoints'][len(self.__data__[key]['datapoints']) - StatTable.STAT_TABLE_SIZES[key]:]
+                    self.__data__[key]['datapoints'][trimmed:]
 #        newest = self.__data__['daily']['datapoints'][-1]
 #        idx = len(self.__data__['daily']['datapoints']) - 1
 #        while idx >= 0:
@@ -88,19 +404,36 @@ class StatTable:
 #            idx -= 1
             
     def __append__(self, events, latest=None):
-        empty_value = { LogLineEvent.USERS: 0, LogLineEvent.AUDIO: 0, LogLineEvent.VIDEO: 0, LogLineEvent.ROOM: 0,
-                           'users': {}}
+        """
+        consumes the events in a single forward pass; events can be any
+        iterable sorted by timestamp
+        """
+        empty_value = { LogLineEvent.USERS: 0, LogLineEvent.AUDIO: 0, LogLineEvent.VIDEO: 0, LogLineEvent.ROOM: 0 }
+        events = iter(events)
+        ## holds the event that was read ahead, when it belongs to a later minute
+        lookahead = []
+
         if not latest:
-            latest = { 'timestamp': events[0].timestamp() - 1, 'idx': -1,
+            event = next(events, None)
+            if event is None: return
+            print "Initial logging"
+            lookahead.append(event)
+            latest = { 'timestamp': event.timestamp() - 1, 'idx': -1,
                 'value': dict(empty_value) }
+            self.__session__ = SessionState()
         
         curr_time = latest['timestamp'] + Constants.SECONDS_IN_MIN
         datapoint_idx = latest['idx'] + 1
         counters = dict(latest['value'])
+        session = self.__session__
 
         final_time = calendar.timegm(datetime.datetime.today().timetuple())
-        events_idx = 0
         
+        def unmatched(event):
+            ## the event refers to a user we don't know, or to a state the user is
+            ## not in: the session is out of sync with the server
+            metrics.count('unmatched_events', LogLineEvent.EventTypeNames[event.type()])
+
         increments = {
             LogLineEvent.USER_JOIN: 1, LogLineEvent.USER_LEAVE: -1, LogLineEvent.AUDIO_START: 1, LogLineEvent.AUDIO_STOP: -1,
             LogLineEvent.VIDEO_START: 1, LogLineEvent.VIDEO_STOP: -1, LogLineEvent.ROOM_CREATE: 1, LogLineEvent.ROOM_DESTROY: -1
@@ -108,19 +441,45 @@ class StatTable:
 
         
         while curr_time < final_time:
+
+            ## nothing happens until the minute of the next event (or until now), so
+            ## all the datapoints before it repeat the current counters: add them at once
+            if not lookahead:
+                event = next(events, None)
+                if event is not None: lookahead.append(event)
+
+            idle = (final_time - curr_time + Constants.SECONDS_IN_MIN - 1) // Constants.SECONDS_IN_MIN
+            if lookahead:
+                if lookahead[0].timestamp() < latest['timestamp']:
+                    idle = 0 # we saw this event already, it's skipped below
+                else:
+                    idle = min(idle, max(0, (lookahead[0].timestamp() - curr_time) // Constants.SECONDS_IN_MIN + 1))
+
+            if idle > 0:
+                self.__fill__(dict(counters), curr_time, datapoint_idx, idle)
+                self.__session__ = session
+                curr_time += idle * Constants.SECONDS_IN_MIN
+                datapoint_idx += idle
+                if len(self.__data__['daily']['datapoints']) >= 2 * StatTable.STAT_TABLE_SIZES['daily']:
+                    self.__aggregate__()
+                    self.__slideWindow__()
+                continue
         
             events_handled = []
         
             # take all events in the list whose timestamp is LESS than curr_time
             # but MORE than latest.timestamp
-            while events_idx < len(events):
-                event = events[events_idx]
-                events_idx += 1
+            while True:
+                if lookahead:
+                    event = lookahead.pop()
+                else:
+                    event = next(events, None)
+                    if event is None: break
                 
-                if event.timestamp() <= latest['timestamp']: continue # we saw this event already
+                if event.timestamp() < latest['timestamp']: continue # we saw this event already
                 if event.timestamp() >= curr_time:
                     # this event is for the next minute
-                    events_idx -= 1
+                    lookahead.append(event)
                     break
                 
                 events_handled.append(event)
@@ -130,87 +489,82 @@ class StatTable:
                 ## specific event handling
                 if event.type() == LogLineEvent.USER_JOIN:
                     ## the user is joining, so we add him/her to the persistent list of users
-                    try: counters['users'][event.user_id()] = { 'audio': False, 'video': False, 'username': '', 'audio_id': 0, 'room_id': '' }
-                    except: print 'Handling exception on line %d' % (sys.exc_traceback.tb_lineno)
+                    try: session.join(event.user_id())
+                    except: metrics.count('handler_errors', LogLineEvent.EventTypeNames[event.type()])
                     
                 elif event.type() == LogLineEvent.USER_NAME:
                     ## the user is being named, we must track this name for the audio start/stop events
-                    try: 
-                        counters['users'][event.user_id()]['username'] = event.username()
-                        counters['users'][event.user_id()]['room_id'] = event.room_id()
-                    except: print 'Handling exception on line %d' % (sys.exc_traceback.tb_lineno)
+                    try: session.update(event.user_id(), username=event.username(), room_id=event.room_id())
+                    except: metrics.count('handler_errors', LogLineEvent.EventTypeNames[event.type()])
 
                 elif event.type() == LogLineEvent.USER_LEAVE:
                     try:
-                        if not counters['users'].has_key(event.user_id()): continue
-                        counters[LogLineEvent.VIDEO] -= 1 if counters['users'][event.user_id()]['video'] else 0
-                        counters[LogLineEvent.AUDIO] -= 1 if counters['users'][event.user_id()]['audio'] else 0
-                        del counters['users'][event.user_id()]
-                    except: print 'Handling exception on line %d' % (sys.exc_traceback.tb_lineno)
+                        if event.user_id() not in session: unmatched(event); continue
+                        user = session.leave(event.user_id())
+                        counters[LogLineEvent.VIDEO] -= 1 if user['video'] else 0
+                        counters[LogLineEvent.AUDIO] -= 1 if user['audio'] else 0
+                    except: metrics.count('handler_errors', LogLineEvent.EventTypeNames[event.type()])
 
                 ## start/stop video
                 elif event.type() == LogLineEvent.VIDEO_START:
                     try:
-                        if counters['users'][event.user_id()]['video']: continue
-                        counters['users'][event.user_id()]['video'] = True
-                    except: print 'Handling exception on line %d' % (sys.exc_traceback.tb_lineno)
+                        if session[event.user_id()]['video']: unmatched(event); continue
+                        session.update(event.user_id(), video=True)
+                    except: metrics.count('handler_errors', LogLineEvent.EventTypeNames[event.type()])
                 elif event.type() == LogLineEvent.VIDEO_STOP:
                     try:
-                        if counters['users'].has_key(event.user_id()):
-                            if not counters['users'][event.user_id()]['video']: continue
-                            counters['users'][event.user_id()]['video'] = False
-                        else: continue
-                    except: print 'Handling exception on line %d' % (sys.exc_traceback.tb_lineno)
+                        if event.user_id() in session:
+                            if not session[event.user_id()]['video']: unmatched(event); continue
+                            session.update(event.user_id(), video=False)
+                        else: unmatched(event); continue
+                    except: metrics.count('handler_errors', LogLineEvent.EventTypeNames[event.type()])
 
                 ## start/stop audio
                 elif event.type() == LogLineEvent.AUDIO_ID:
                     ## we acquire the audio id for the user
                     try:
-                        candidates_id = [k for k, v in counters['users'].iteritems() if v['username'] == event.username() and not v['audio'] and v['audio_id'] == 0]
-                        if len(candidates_id) > 0:
-                            counters['users'][candidates_id[0]]['audio_id'] = event.audio_id()
-                        else: continue
-                    except: print 'Handling exception on line %d' % (sys.exc_traceback.tb_lineno)
+                        user_id = session.awaiting_audio_id(event.username())
+                        if user_id is not None:
+                            session.update(user_id, audio_id=event.audio_id())
+                        else: unmatched(event); continue
+                    except: metrics.count('handler_errors', LogLineEvent.EventTypeNames[event.type()])
 
                 elif event.type() == LogLineEvent.AUDIO_START:
                     try:
-                        candidates_id = [k for k, v in counters['users'].iteritems() if v['username'] == event.username() and not v['audio'] and v['audio_id'] != 0]
-                        if len(candidates_id) > 0:
-                            counters['users'][candidates_id[0]]['audio'] = True
-                        else: continue
-                    except: print 'Handling exception on line %d' % (sys.exc_traceback.tb_lineno)
+                        user_id = session.awaiting_audio_start(event.username())
+                        if user_id is not None:
+                            session.update(user_id, audio=True)
+                        else: unmatched(event); continue
+                    except: metrics.count('handler_errors', LogLineEvent.EventTypeNames[event.type()])
 
                 elif event.type() == LogLineEvent.AUDIO_STOP:
                     try:
-                        candidates_id = [k for k, v in counters['users'].iteritems() if v['audio_id'] == event.audio_id() and v['audio']]
-                        if len(candidates_id) > 0:
-                            counters['users'][candidates_id[0]]['audio'] = False
-                            counters['users'][candidates_id[0]]['audio_id'] = 0
-                        else: continue
-                    except: print 'Handling exception on line %d' % (sys.exc_traceback.tb_lineno)
+                        user_id = session.with_audio(event.audio_id())
+                        if user_id is not None:
+                            session.update(user_id, audio=False, audio_id=0)
+                        else: unmatched(event); continue
+                    except: metrics.count('handler_errors', LogLineEvent.EventTypeNames[event.type()])
                 
                 elif event.type() == LogLineEvent.SERVER_RESTARTED:
                     counters = dict(empty_value)
-                    ## it's necessary because when I copy a dictionary, the subdictionary 
-                    ## are references, and must be erased
-                    counters['users'] = {}
+                    session = SessionState()
                     
                 elif event.type() == LogLineEvent.ROOM_DESTROY:
                     try:
-                        candidates_id = [k for k, v in counters['users'].iteritems() if v['room_id'] == event.room_id()]
-                        for user_id in candidates_id:
-                            counters[LogLineEvent.VIDEO] -= 1 if counters['users'][user_id]['video'] else 0
-                            counters[LogLineEvent.AUDIO] -= 1 if counters['users'][user_id]['audio'] else 0
+                        for user_id in session.in_room(event.room_id()):
+                            user = session.leave(user_id)
+                            counters[LogLineEvent.VIDEO] -= 1 if user['video'] else 0
+                            counters[LogLineEvent.AUDIO] -= 1 if user['audio'] else 0
                             counters[LogLineEvent.USERS] -= 1
-                            del counters['users'][user_id]
-                    except: print 'Handling exception on line %d' % (sys.exc_traceback.tb_lineno)
+                    except: metrics.count('handler_errors', LogLineEvent.EventTypeNames[event.type()])
                 
                 ## we skip some of the control events
                 if event.type() not in [LogLineEvent.USER_NAME, LogLineEvent.AUDIO_ID, LogLineEvent.SERVER_RESTARTED]:
                     try: counters[event_type] += increments[event.type()]
-                    except: print 'Handling exception on line %d' % (sys.exc_traceback.tb_lineno)
+                    except: metrics.count('handler_errors', LogLineEvent.EventTypeNames[event.type()])
 
             self.__data__['daily']['datapoints'].append({'timestamp': curr_time, 'value': dict(counters), 'idx': datapoint_idx})
+            self.__session__ = session
             curr_time += Constants.SECONDS_IN_MIN
             datapoint_idx += 1;
 
@@ -219,71 +573,269 @@ class StatTable:
                 print events_handled
                 print counters, '\n'
                 
-                ## it will write into eventlines.log all the valuable lines of the bigbluebutton log file
-                logfile = open('eventlines.log', 'a')
-                for event in events_handled:
-                    logfile.write(event.line())
-                logfile.close()
+                ## the events are kept in the archive, to be read again without the log
+                if self.__archive__ is not None:
+                    self.__archive__.write(events_handled)
+
+            ## on long catch-ups, roll up and trim as we go, so memory is
+            ## bounded by the window sizes instead of the time elapsed
+            if len(self.__data__['daily']['datapoints']) >= 2 * StatTable.STAT_TABLE_SIZES['daily']:
+                self.__aggregate__()
+                self.__slideWindow__()
+
+        ## the remaining events are for the current minute, they'll be seen
+        ## again next time; let the source run to its end anyway (a LogTail
+        ## only records its new position once all lines are read)
+        for event in events: pass
+
+    def __fill__(self, value, start_time, start_idx, count):
+        """
+        appends count daily datapoints, one per minute from start_time on, all with
+        the same value. Long runs (after the server was idle or we were not running
+        for a while) are not built minute by minute: their rollups are computed
+        directly, and only the daily datapoints that can still be needed are added
+        """
+        daily = self.__data__['daily']['datapoints']
+        longest_frame = max(StatTable.STAT_AGGREGATION_SIZES.values())
+
+        def datapoint(offset):
+            return {'timestamp': start_time + offset * Constants.SECONDS_IN_MIN,
+                'value': value, 'idx': start_idx + offset}
+
+        if count <= 2 * longest_frame + StatTable.STAT_TABLE_SIZES['daily']:
+            daily.extend([datapoint(offset) for offset in xrange(count)])
+            return
+
+        ## first add enough datapoints to close the frames that started before
+        ## the run, and roll them up as usual
+        daily.extend([datapoint(offset) for offset in xrange(longest_frame)])
+        self.__aggregate__()
+
+        ## from now on every complete frame lies within the run, so all its
+        ## statistics are the run value
+        counter = {}
+        for metric in StatTable.STAT_METRICS:
+            counter[metric] = value[metric]
+            counter[metric + '_min'] = value[metric]
+            counter[metric + '_mean'] = float(value[metric])
+            counter[metric + '_p95'] = float(value[metric])
+
+        daily_head = daily[0]['idx']
+        last_idx = start_idx + count - 1
+        for key in ['weekly', 'monthly', 'annually']:
+            frame_size = StatTable.STAT_AGGREGATION_SIZES[key]
+            key_next = daily_head
+            if len(self.__data__[key]['datapoints']) != 0:
+                key_next = self.__data__[key]['datapoints'][-1]['idx'] + 1
+            n_frames = (last_idx - key_next + 1) // frame_size
+
+            def frame(frame_idx):
+                frame_last = key_next + (frame_idx + 1) * frame_size - 1
+                return {'idx': frame_last, 'value': counter,
+                    'timestamp': float(start_time + (frame_last - start_idx) * Constants.SECONDS_IN_MIN)}
+
+            ## older frames would just be slid out of the window, along with the
+            ## ones it had: they go to the history, those frames as a single run
+            skipped = max(0, n_frames - StatTable.STAT_TABLE_SIZES[key])
+            if skipped > 0:
+                self.__history__.write(key, self.__data__[key]['datapoints'])
+                self.__history__.write_run(key, frame(0), skipped,
+                    frame_size * Constants.SECONDS_IN_MIN, frame_size)
+                self.__data__[key]['datapoints'] = []
+
+            for frame_idx in xrange(skipped, n_frames):
+                self.__data__[key]['datapoints'].append(frame(frame_idx))
+
+        ## the daily window only needs its last datapoints, which also cover the
+        ## incomplete frames left at the end of the run; the ones it had go to
+        ## the history, as if they were slid out, and so do the minutes between
+        ## them, as a single run
+        keep = count - StatTable.STAT_TABLE_SIZES['daily']
+        self.__history__.write('daily', daily)
+        self.__history__.write_run('daily', datapoint(longest_frame), keep - longest_frame,
+            Constants.SECONDS_IN_MIN, 1)
+        self.__data__['daily']['datapoints'] = [datapoint(offset) for offset in xrange(keep, count)]
 
     def __aggregate__(self):
-
+        """
+        rolls the daily datapoints up into the other windows. Each rollup datapoint
+        holds, for each metric, the maximum over its frame (under the metric name)
+        and its min, mean and p95 (under metric + '_' + statistic)
+        """
+        start_time = time.time()
+        daily = self.__data__['daily']['datapoints']
+        daily_head = daily[0]['idx']
+
+        ## the first daily datapoint not captured in each summary yet; frames
+        ## start right after the last one rolled up, so they don't depend on
+        ## how many datapoints each call sees
+        starts = {}
         for key in ['weekly', 'monthly', 'annually']:
-            key_tail = 0
+            key_next = daily_head
             if len(self.__data__[key]['datapoints']) != 0:
-                key_tail = self.__data__[key]['datapoints'][-1]['idx']
-            
-            daily_head = self.__data__['daily']['datapoints'][0]['idx']
+                key_next = self.__data__[key]['datapoints'][-1]['idx'] + 1
+            starts[key] = max(key_next - daily_head, 0)
 
-            ## new events contains all daily events not captured in the weekly summary yet
-            new_events = list(self.__data__['daily']['datapoints'][key_tail - daily_head:])
+        ## the daily values not rolled up by every window yet, one column per metric
+        first = min(starts.values())
+        columns = dict([(metric, Rollup.column(daily[first:], metric)) for metric in StatTable.STAT_METRICS])
 
+        for key in ['weekly', 'monthly', 'annually']:
             frame_size = StatTable.STAT_AGGREGATION_SIZES[key]
-            n_frames = len(new_events) / frame_size
-            for frame_idx in range(n_frames):
-                ## turn the strings into component tuples
-                frame = new_events[frame_idx*frame_size: (frame_idx+1)*frame_size]
-
-                ## last frame is incomplete; let's ignore it for now
-                if len(frame) != frame_size: break
-
-                ## extract the value for each metric
-                counter = dict([(x, 0.0) for x in frame[0]['value'].keys()])
+            start = starts[key]
+            n_frames = (len(daily) - start) / frame_size
+            if n_frames == 0: continue
 
-                ## it will keep the maximum value for each metric
-                for datapoint in frame:
-                    for metric in [LogLineEvent.USERS, LogLineEvent.AUDIO, LogLineEvent.VIDEO, LogLineEvent.ROOM]:
-                        if counter[metric] < datapoint['value'][metric]:
-                            counter[metric] = datapoint['value'][metric] 
+            ## whole frames are reduced at once, incomplete last frame is ignored for now
+            stats = dict([(metric, Rollup.rollup(columns[metric][start - first:], frame_size))
+                for metric in StatTable.STAT_METRICS])
 
-                ## the timestamp for the value will be the one from the last daily event
-                curr_time = float(frame[-1]['timestamp'])
+            for frame_idx in range(n_frames):
+                counter = {}
+                for metric in StatTable.STAT_METRICS:
+                    counter[metric] = stats[metric]['max'][frame_idx]
+                    for statistic in Rollup.STATISTICS:
+                        counter[metric + '_' + statistic] = stats[metric][statistic][frame_idx]
 
-                ## the index for the value will be the one from the last daily event, also
-                datapoint_idx = int(frame[-1]['idx'])
+                ## the timestamp and the index for the value will be the ones from
+                ## the last daily event of the frame
+                last = daily[start + (frame_idx + 1) * frame_size - 1]
 
                 ## add to our datapoints
-                self.__data__[key]['datapoints'].append({'timestamp': curr_time, 'value': counter, 'idx': datapoint_idx})
+                self.__data__[key]['datapoints'].append({'timestamp': float(last['timestamp']),
+                    'value': counter, 'idx': int(last['idx'])})
+
+        metrics.add_time('aggregate', time.time() - start_time)
 
     def update(self, events):
         """
-        Note: we assume events is sorted by timestamp
+        Note: we assume events is sorted by timestamp. It can be a list or
+        any other iterable, such as the generator returned by iterparse()
         """
 #        print events
 
-        if len(events) > 0:
-            if len(self.__data__['daily']['datapoints']) == 0:
-                # no data yet, so we start scanning dates from
-                # the start of the events list
-                print "Initial logging"
-                self.__append__(events)
-            else:
-                # if we already have some data in the file, we
-                # start scanning from the last timestamp in the file
-                latest = self.__data__['daily']['datapoints'][-1]
-                self.__append__(events, latest)
+        ## the events are parsed while they are appended, so the parse time
+        ## (and the rollups done along the way) are not counted as append time
+        start = time.time()
+        parsed = metrics.elapsed('parse') + metrics.elapsed('aggregate')
+
+        if len(self.__data__['daily']['datapoints']) == 0:
+            # no data yet, so we start scanning dates from
+            # the start of the events list (if there are events at all)
+            self.__append__(events)
+        else:
+            # if we already have some data in the file, we
+            # start scanning from the last timestamp in the file;
+            # this also runs with no new events, since the log is
+            # tailed and idle minutes still need their datapoints
+            latest = self.__data__['daily']['datapoints'][-1]
+            self.__append__(events, latest)
+
+        metrics.add_time('append', time.time() - start -
+            (metrics.elapsed('parse') + metrics.elapsed('aggregate') - parsed))
 
         if len(self.__data__['daily']['datapoints']) > 0:
             self.__aggregate__()
 
         self.__slideWindow__()
+        self.__persist__()
+
+    def __persist__(self):
+        start = time.time()
+        changed = [key for key in self.__data__ if self.__lastIdx__(key) != self.__persisted__[key]]
+
+        ## the archive and history go first, so they have at least the events
+        ## in the data, and the datapoints no longer in it; the session goes
+        ## before the data, which can then always be resumed (see __readSession__)
+        if self.__archive__ is not None:
+            self.__archive__.flush()
+        self.__history__.flush()
+        self.__writeSession__()
         self.__writeFile__()
+        self.__writeResponses__(changed)
+        metrics.add_time('write', time.time() - start)
+
+        for name, filename in [('data', self.__filename__), ('journal', self.__journalfile__),
+                ('session', self.__sessionfile__)]:
+            if os.path.exists(filename):
+                metrics.gauge('file_bytes', name, os.path.getsize(filename))
+
+    def __writeResponses__(self, changed):
+        # the transposed series of each window, and all the windows as they are
+        # stored, in the JSON the web server sends; only the changed ones (or
+        # the missing ones) are written again
+        windows = ['daily', 'weekly', 'monthly', 'annually']
+        responses = [(key, lambda key=key: Series.transpose(self.__data__[key])) for key in windows] + \
+            [('all', lambda: dict([(key, self.__data__[key]) for key in windows]))]
+
+        for window, output in responses:
+            filename = response_filename(self.__filename__, window)
+            deflated = response_filename(self.__filename__, window, deflated=True)
+            if window not in changed and not (window == 'all' and changed) and \
+                    os.path.exists(filename) and os.path.exists(deflated):
+                continue
+
+            body = json.dumps(output())
+            for name, content in [(filename, body), (deflated, Deflate.precompress(body))]:
+                f = open(name + '.tmp', 'wb')
+                f.write(content)
+                f.close()
+                os.rename(name + '.tmp', name)
+            metrics.count('responses_written', window)
+
+    def merge(self, tables):
+        """
+        adds the datapoints of a cluster: for each minute after the latest datapoint,
+        the sum of the counters of tables (the daily datapoints of each server, as
+        read by read_data) at that minute. Each server counts with its latest datapoint
+        at or before the minute, or zero before its first one, so servers don't need
+        to agree on the second their minutes start. Minutes some server hasn't reached
+        yet are left for later.
+        """
+        tables = [table for table in tables if len(table) > 0]
+        if len(tables) == 0: return
+
+        ## the datapoints of each server, by the start of their minute
+        minutes = [[int(datapoint['timestamp']) - int(datapoint['timestamp']) % Constants.SECONDS_IN_MIN
+            for datapoint in table] for table in tables]
+        first = min([table_minutes[0] for table_minutes in minutes])
+        last = max(first, min([table_minutes[-1] for table_minutes in minutes]))
+
+        daily = self.__data__['daily']['datapoints']
+        if len(daily) > 0:
+            curr_time = int(daily[-1]['timestamp']) + Constants.SECONDS_IN_MIN
+            datapoint_idx = daily[-1]['idx'] + 1
+        else:
+            curr_time = first
+            datapoint_idx = 0
+
+        empty_value = dict([(metric, 0) for metric in StatTable.STAT_METRICS])
+
+        ## before the data of every server, the cluster was empty
+        if curr_time < first:
+            idle = (first - curr_time) // Constants.SECONDS_IN_MIN
+            self.__fill__(empty_value, curr_time, datapoint_idx, idle)
+            curr_time += idle * Constants.SECONDS_IN_MIN
+            datapoint_idx += idle
+
+        while curr_time <= last:
+            value = dict(empty_value)
+            for table, table_minutes in zip(tables, minutes):
+                position = bisect.bisect_right(table_minutes, curr_time) - 1
+                if position < 0: continue
+                for metric in StatTable.STAT_METRICS:
+                    value[metric] += table[position]['value'][metric]
+
+            self.__data__['daily']['datapoints'].append({'timestamp': curr_time, 'value': value, 'idx': datapoint_idx})
+            curr_time += Constants.SECONDS_IN_MIN
+            datapoint_idx += 1
+
+            if len(self.__data__['daily']['datapoints']) >= 2 * StatTable.STAT_TABLE_SIZES['daily']:
+                self.__aggregate__()
+                self.__slideWindow__()
+
+        if len(self.__data__['daily']['datapoints']) > 0:
+            self.__aggregate__()
+
+        self.__slideWindow__()
+        self.__persist__()
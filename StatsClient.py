@@ -0,0 +1,58 @@
+import json
+import urllib
+import urllib2
+
+from StatTable import StatTable
+
+class StatsClient:
+    """
+    StatsClient keeps a local copy of the windows served by /stats/ and polls
+    only for the datapoints it doesn't have yet (?since_idx=), so each poll
+    costs a few datapoints instead of whole windows. The datapoints are kept as
+    they are stored, in windows[key], trimmed to the sizes of a StatTable. Each
+    window is asked from its own last idx, since a rolled up datapoint can be
+    written after the daily one with the same idx.
+    """
+
+    WINDOWS = ['daily', 'weekly', 'monthly', 'annually']
+
+    def __init__(self, url, window='all'):
+        self.url = url
+        self.window = window
+        self.head = -1
+        self.windows = {}
+
+    def poll(self):
+        """
+        fetches and merges the datapoints written since the last poll; returns
+        how many there were
+        """
+        keys = StatsClient.WINDOWS if self.window == 'all' else [self.window]
+        lasts = []
+        for key in keys:
+            datapoints = self.windows.get(key, [])
+            lasts.append('%s:%d' % (key, datapoints[-1]['idx'] if len(datapoints) > 0 else -1))
+        query = urllib.urlencode({'window': self.window, 'since_idx': ','.join(lasts), 'callback': ''})
+        body = urllib2.urlopen(self.url + '?' + query).read()
+        return self.merge(json.loads(body[body.index('(') + 1:body.rindex(')')]))
+
+    def merge(self, delta):
+        """
+        merges a delta answered by /stats/?since_idx= into the windows; returns
+        the number of new datapoints
+        """
+        ## the data was reset (or is from another server): start over
+        if delta['head'] < self.head:
+            self.windows = {}
+
+        count = 0
+        for key, points in delta['datapoints'].items():
+            datapoints = self.windows.setdefault(key, [])
+            last = datapoints[-1]['idx'] if len(datapoints) > 0 else None
+            points = [datapoint for datapoint in points if last is None or datapoint['idx'] > last]
+            datapoints.extend(points)
+            del datapoints[:-StatTable.STAT_TABLE_SIZES[key]]
+            count += len(points)
+
+        self.head = delta['head']
+        return count
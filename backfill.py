@@ -0,0 +1,138 @@
+#! /usr/bin/python
+
+import sys
+import os
+import re
+import itertools
+import collections
+import multiprocessing
+
+from LogLineEvent import iterparse, LogLineEvent
+from StatTable import StatTable, acquire_lock
+from LogTail import LogTail
+from Metrics import metrics
+
+## number of archives parsed ahead of the one being replayed; each of them
+## is held in memory whole (as a list of events) until its turn comes
+PARSE_AHEAD = 2
+
+def archives(logfile):
+    """
+    the rotated copies of logfile (logfile.N, or logfile.N.gz once compressed),
+    oldest first
+    """
+    directory = os.path.dirname(logfile) or '.'
+    pattern = re.compile(re.escape(os.path.basename(logfile)) + r'\.(\d+)(\.gz)?$')
+
+    found = []
+    for name in os.listdir(directory):
+        match = pattern.match(name)
+        if match:
+            found.append((int(match.group(1)), os.path.join(directory, name)))
+    found.sort(reverse=True)
+    return [name for number, name in found]
+
+def parse_file(filename):
+    """
+    the events of a whole log file; runs in a worker process
+    """
+    return filename, list(iterparse(filename))
+
+def parse_files(pool, filenames, ahead=PARSE_AHEAD):
+    """
+    generator of (filename, events) for the files, in order, parsed by the pool.
+    Only ahead files are parsed (or waiting) at a time besides the one handed
+    out, so the memory used doesn't grow with the number of archives
+    """
+    filenames = iter(filenames)
+    pending = collections.deque()
+    for filename in itertools.islice(filenames, ahead):
+        pending.append(pool.apply_async(parse_file, (filename,)))
+
+    while pending:
+        result = pending.popleft().get()
+        for filename in itertools.islice(filenames, 1):
+            pending.append(pool.apply_async(parse_file, (filename,)))
+        yield result
+
+def identity(event):
+    ## what tells apart two events logged in the same second
+    return (event.type(), event.user_id(), event.username(), event.room_id(), event.audio_id())
+
+def stitch(files):
+    """
+    chains the events of consecutive log files, given as (filename, events) in
+    time order. Events at the start of a file that are older than the end of the
+    previous one, or repeat its last events (as when logs are rotated with
+    copytruncate), are dropped
+    """
+    last = None
+    seen = set()
+    for filename, events in files:
+        overlapping = last is not None
+        skipped = 0
+        restarted = False
+        for event in events:
+            if overlapping:
+                if event.timestamp() < last or (event.timestamp() == last and identity(event) in seen):
+                    skipped += 1
+                    continue
+                overlapping = False
+                restarted = event.type() == LogLineEvent.SERVER_RESTARTED
+
+            if event.timestamp() != last:
+                last = event.timestamp()
+                seen = set()
+            seen.add(identity(event))
+            yield event
+
+        if skipped > 0:
+            print "%s: skipped %d events already in the previous log" % (filename, skipped)
+        if restarted:
+            print "%s: starts with a server restart" % filename
+
+def current(logfile, tail):
+    ## the current log goes last, through the tail, so the next runs of
+    ## main.py go on from where the backfill stopped
+    yield logfile, iterparse(logfile, tail)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print "usage: " + sys.argv[0] + " [logfile] [datafile]"
+        print "where [logfile] is the latest bigbluebutton log file, whose rotated"
+        print "                copies ([logfile].1, [logfile].2.gz, ...) are read first"
+        print "      [datafile] is the file for the output data, which must be new"
+        sys.exit(0)
+
+    logfile = sys.argv[1]
+    datafile = sys.argv[2]
+
+    lock = acquire_lock(datafile)
+    if lock is None:
+        print "%s is locked by another run, skipping" % datafile
+        sys.exit(0)
+
+    statTable = StatTable(datafile)
+    if statTable.latest() is not None:
+        print "%s already has data; events older than its latest datapoint would be skipped" % datafile
+        sys.exit(1)
+
+    ## a checkpoint left with no data (a run that was interrupted, or a data
+    ## file that was removed) would skip the start of the current log
+    if os.path.exists(datafile + '.tail'):
+        print "%s: ignoring the checkpoint left by a previous run" % (datafile + '.tail')
+        os.remove(datafile + '.tail')
+
+    ## the next archives are parsed in parallel while one is replayed, in order;
+    ## the replay itself needs the session state of everything before it, so
+    ## it's sequential (idle stretches are filled in bulk)
+    pool = multiprocessing.Pool(min(PARSE_AHEAD, multiprocessing.cpu_count()))
+    tail = LogTail(logfile, datafile + '.tail')
+    files = parse_files(pool, archives(logfile))
+
+    statTable.update(stitch(itertools.chain(files, current(logfile, tail))))
+    pool.close()
+    pool.join()
+
+    tail.commit(statTable.latest())
+    metrics.write(datafile + '.metrics')
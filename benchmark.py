@@ -0,0 +1,158 @@
+#! /usr/bin/python
+
+import sys
+import os
+import time
+import json
+import shutil
+import resource
+import tempfile
+import datetime
+import platform
+import multiprocessing
+
+from loggen import LogGenerator
+from LogLineEvent import iterparse
+from StatTable import StatTable
+
+## number of generated events for each scale
+SCALES = [10000, 100000, 1000000]
+
+## requests made to measure the latency of each GET
+REQUESTS = 20
+
+def measure_get(datafile):
+    """
+    latency of /stats/ requests, in milliseconds: the first one (nothing cached
+    yet), the following ones, and the ones answered with 304 Not Modified.
+    Returns None when web.py is not available
+    """
+    try:
+        import web
+        import web_server
+    except ImportError:
+        return None
+
+    ## the web server takes the data file from its command line
+    sys.argv[2:] = [datafile]
+    app = web.application(('/stats/(.*)', 'MconfStatisticsWebService'), vars(web_server))
+
+    result = {}
+    for window in ['daily', 'all']:
+        path = '/stats/?window=%s&callback=cb' % window
+
+        start = time.time()
+        response = app.request(path)
+        first = time.time() - start
+
+        start = time.time()
+        for i in xrange(REQUESTS):
+            app.request(path)
+        cached = (time.time() - start) / REQUESTS
+
+        etag = dict(response.headers).get('ETag')
+        start = time.time()
+        for i in xrange(REQUESTS):
+            app.request(path, headers={'If-None-Match': etag})
+        not_modified = (time.time() - start) / REQUESTS
+
+        result[window] = {'first_ms': first * 1000, 'cached_ms': cached * 1000,
+            'not_modified_ms': not_modified * 1000, 'bytes': len(response.data)}
+    return result
+
+def run_scale(steps, directory):
+    """
+    generates a log with steps events and runs everything on it; runs in its own
+    process, so the peak RSS is only the one of this scale
+    """
+    os.chdir(directory)
+    logfile = os.path.join(directory, 'bigbluebutton.log')
+    datafile = os.path.join(directory, 'data.log')
+
+    ## the log ends just before now (the local time, as StatTable takes it), so
+    ## the update doesn't also time filling in the idle minutes up to now; the
+    ## time a log spans only depends on the parameters, so a first pass finds it
+    generator = LogGenerator(open(os.devnull, 'w'), restarts=steps / 100000)
+    start = generator.time
+    generator.generate(steps)
+    span = generator.time - start
+
+    out = open(logfile, 'w')
+    LogGenerator(out, start=datetime.datetime.today() - span, restarts=steps / 100000).generate(steps)
+    out.close()
+
+    lines = 0
+    for line in open(logfile, 'r'):
+        lines += 1
+
+    ## parsing alone
+    start = time.time()
+    events = list(iterparse(logfile))
+    parse_time = time.time() - start
+
+    ## appending the events (and writing the data), from an empty table; what
+    ## it prints for each minute is left out
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    statTable = StatTable(datafile)
+    start = time.time()
+    statTable.update(events)
+    update_time = time.time() - start
+    sys.stdout = stdout
+
+    ## rolling up a whole daily window again
+    statTable = StatTable(datafile)
+    for key in ['weekly', 'monthly', 'annually']:
+        statTable.__data__[key]['datapoints'] = []
+    start = time.time()
+    statTable.__aggregate__()
+    aggregate_time = time.time() - start
+
+    size = 0
+    for name in [datafile, datafile + '.journal']:
+        if os.path.exists(name):
+            size += os.path.getsize(name)
+
+    return {
+        'steps': steps,
+        'lines': lines,
+        'events': len(events),
+        'log_bytes': os.path.getsize(logfile),
+        'parse_seconds': parse_time,
+        'lines_per_second': lines / parse_time,
+        'events_per_second': len(events) / parse_time,
+        'update_seconds': update_time,
+        'aggregate_seconds': aggregate_time,
+        'data_file_bytes': size,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'get': measure_get(datafile)
+    }
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print "usage: " + sys.argv[0] + " [output] [scale ...]"
+        print "where [output] is the JSON file for the results and"
+        print "      [scale] are the numbers of events to generate (default: %s)" % ' '.join(map(str, SCALES))
+        sys.exit(0)
+
+    scales = [int(scale) for scale in sys.argv[2:]] or SCALES
+    results = {'python': platform.python_version(), 'machine': platform.machine(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'scales': []}
+
+    for steps in scales:
+        directory = tempfile.mkdtemp(prefix='mconf-benchmark-')
+        pool = multiprocessing.Pool(1)
+        try:
+            result = pool.apply(run_scale, (steps, directory))
+        finally:
+            pool.close()
+            pool.join()
+            shutil.rmtree(directory)
+
+        print "%(steps)d steps: %(lines_per_second).0f lines/s, %(events_per_second).0f events/s, " \
+            "update %(update_seconds).2fs, aggregate %(aggregate_seconds).3fs, %(peak_rss_kb)d KB peak" % result
+        results['scales'].append(result)
+
+    f = open(sys.argv[1], 'w')
+    f.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+    f.close()
@@ -0,0 +1,58 @@
+#! /usr/bin/python
+
+import sys
+import multiprocessing
+
+from LogLineEvent import iterparse
+from StatTable import StatTable, acquire_lock, read_data, read_manifest
+from LogTail import LogTail
+from Metrics import metrics
+
+def update_server(server):
+    """
+    does for one server what main.py does; runs in a worker process
+    """
+    name, logfile, datafile = server
+    metrics.reset()
+
+    lock = acquire_lock(datafile)
+    if lock is None:
+        print "%s is locked by another run, skipping" % datafile
+        return name
+
+    tail = LogTail(logfile, datafile + '.tail')
+    statTable = StatTable(datafile)
+    statTable.update(iterparse(logfile, tail))
+    tail.commit(statTable.latest())
+    metrics.write(datafile + '.metrics')
+
+    lock.close()
+    return name
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print "usage: " + sys.argv[0] + " [manifest] [datafile]"
+        print "where [manifest] lists the servers, one per line, as"
+        print "                 [name] [logfile] [datafile]"
+        print "      [datafile] is the file for the cluster data"
+        sys.exit(0)
+
+    servers = read_manifest(sys.argv[1])
+
+    lock = acquire_lock(sys.argv[2])
+    if lock is None:
+        print "%s is locked by another run, skipping" % sys.argv[2]
+        sys.exit(0)
+
+    ## each server is parsed and updated in its own process
+    if len(servers) > 0:
+        pool = multiprocessing.Pool(min(len(servers), multiprocessing.cpu_count()))
+        pool.map(update_server, servers)
+        pool.close()
+        pool.join()
+
+    ## then their daily datapoints are summed up into the cluster table, which
+    ## rolls them up as any other
+    tables = [read_data(datafile, ['daily'])['daily']['datapoints'] for name, logfile, datafile in servers]
+    StatTable(sys.argv[2], archive=False).merge(tables)
+    metrics.write(sys.argv[2] + '.metrics')
@@ -0,0 +1,97 @@
+#! /usr/bin/python
+
+import sys
+import os
+import time
+import datetime
+import calendar
+
+import Constants
+from daemon import Daemon
+from LogLineEvent import iterparse
+from StatTable import StatTable, acquire_lock
+from LogTail import LogTail
+from Metrics import metrics
+
+class CollectorDaemon(Daemon):
+    """
+    CollectorDaemon does the job of main.py without being started again every
+    minute: the StatTable and the session state stay in memory, the log is polled
+    for the lines appended to it (following rotations, as LogTail does), and each
+    datapoint is added, and written, as soon as its minute is over. The events
+    of the current minute are kept aside until then, so no line is read twice.
+    """
+
+    ## seconds between two looks at the log
+    POLL_SECONDS = 1
+
+    ## seconds to wait after a minute is over before adding its datapoint, for
+    ## the lines the logger may still be writing
+    SETTLE_SECONDS = 2
+
+    def __init__(self, pidfile, logfile, datafile):
+        Daemon.__init__(self, pidfile)
+        self.logfile = os.path.abspath(logfile)
+        self.datafile = os.path.abspath(datafile)
+
+    def run(self):
+        lock = acquire_lock(self.datafile)
+        if lock is None:
+            print "%s is locked by another run, exiting" % self.datafile
+            sys.exit(1)
+
+        tail = LogTail(self.logfile, self.datafile + '.tail')
+        statTable = StatTable(self.datafile)
+
+        ## catch up with what was logged while we were not running, streaming
+        ## the events; the lines of the current minute are read again below
+        statTable.update(iterparse(self.logfile, tail))
+        tail.commit(statTable.latest())
+
+        pending = []
+        while True:
+            pending.extend(iterparse(self.logfile, tail))
+
+            now = calendar.timegm(datetime.datetime.today().timetuple())
+            latest = statTable.latest()
+            if latest is None:
+                due = now if pending else None
+            else:
+                due = latest + Constants.SECONDS_IN_MIN + CollectorDaemon.SETTLE_SECONDS
+
+            if due is not None and now >= due:
+                statTable.update(pending)
+                latest = statTable.latest()
+                if latest is not None:
+                    ## only the events after the latest datapoint are still to come
+                    pending = [event for event in pending if event.timestamp() >= latest]
+
+                    ## the checkpoint goes back to the latest datapoint written, but
+                    ## the tail goes on reading from where it is
+                    tail.commit(latest, rewind=False)
+
+                ## counted since the collector started
+                metrics.write(self.datafile + '.metrics')
+
+            time.sleep(CollectorDaemon.POLL_SECONDS)
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2:
+        if 'start' == sys.argv[1] and len(sys.argv) >= 4:
+            daemon = CollectorDaemon('/tmp/statistics-collector.pid', sys.argv[2], sys.argv[3])
+            daemon.start()
+        elif 'stop' == sys.argv[1]:
+            daemon = CollectorDaemon('/tmp/statistics-collector.pid', '', '')
+            daemon.stop()
+        elif 'restart' == sys.argv[1] and len(sys.argv) >= 4:
+            daemon = CollectorDaemon('/tmp/statistics-collector.pid', sys.argv[2], sys.argv[3])
+            daemon.restart()
+        else:
+            print "Unknown command"
+            sys.exit(2)
+        sys.exit(0)
+    else:
+        print "usage: %s start|stop|restart [logfile] [datafile]" % sys.argv[0]
+        print "where [logfile] is the latest bigbluebutton log file and"
+        print "      [datafile] is the file for the output data"
+        sys.exit(2)
@@ -0,0 +1,28 @@
+#! /usr/bin/python
+
+import sys, os, json
+from StatTable import StatTable, read_data
+from RingStore import RingStore, is_ring
+
+if len(sys.argv) < 3:
+    print "usage: " + sys.argv[0] + " [source] [destination]"
+    print "where [source] is a data file, either JSON or ring, and"
+    print "      [destination] is the file to write it to in the other format"
+    sys.exit(0)
+
+data = read_data(sys.argv[1])
+
+if is_ring(sys.argv[1]):
+    f = open(sys.argv[2], 'w')
+    f.write(json.dumps(data) + '\n')
+    f.close()
+else:
+    store = RingStore(sys.argv[2], StatTable.layout())
+    store.write(data)
+    store.close()
+
+## the session checkpoint is the same for both formats
+if os.path.exists(sys.argv[1] + '.session'):
+    f = open(sys.argv[2] + '.session', 'w')
+    f.write(file(sys.argv[1] + '.session').read())
+    f.close()
@@ -0,0 +1,97 @@
+#! /usr/bin/python
+
+import re
+import os
+import sys
+import tempfile
+
+from loggen import LogGenerator
+from LogLineEvent import classify, LogLineEvent
+
+## number of generated events when no log is given
+STEPS = 200000
+
+## the patterns LogLineEvent used to match against whole lines, with a greedy
+## group for every field, kept as they were to check the current ones against
+OLD_REGEXES = [
+    (re.compile(".*INFO  o.b.c.BigBlueButtonApplication - \[clientid=(?P<user_id>.*)\] connected.*"), LogLineEvent.USER_JOIN),
+    (re.compile(".*INFO  o.b.c.BigBlueButtonApplication - \[clientid=(?P<user_id>.*)\] disconnnected.*"), LogLineEvent.USER_LEAVE),
+    (re.compile(".*DEBUG o.b.c.BigBlueButtonApplication - User \[userid=(?P<user_id>.*),username=(?P<user_name>.*),role.* connected to room \[(?P<room_id>.*)\]"), LogLineEvent.USER_NAME),
+    (re.compile(".*INFO  o.b.c.s.p.ParticipantsApplication - Creating room (?P<room_id>.*)"), LogLineEvent.ROOM_CREATE),
+    (re.compile(".*INFO  o.b.c.s.p.ParticipantsApplication - Destroying room (?P<room_id>.*)"), LogLineEvent.ROOM_DESTROY),
+    (re.compile(".*DEBUG o.b.conference.RoomsManager - Change participant status (?P<user_id>.*) - hasStream \[true\]"), LogLineEvent.VIDEO_START),
+    (re.compile(".*DEBUG o.b.conference.RoomsManager - Change participant status (?P<user_id>.*) - hasStream \[false\]"), LogLineEvent.VIDEO_STOP),
+    (re.compile(".*DEBUG o.b.w.red5.voice.ClientManager - Participant (?P<user_name>.*)joining room (?P<room_id>.*)"), LogLineEvent.AUDIO_START),
+    (re.compile(".*DEBUG o.b.w.voice.internal.RoomManager - Joined \[(?P<audio_id>.*),(?P<user_name>.*),.*,.*\]*"), LogLineEvent.AUDIO_ID),
+    (re.compile(".*DEBUG o.b.w.red5.voice.ClientManager - Participant \[(?P<audio_id>.*),.*\] leaving"), LogLineEvent.AUDIO_STOP),
+    (re.compile(".*DEBUG ROOT - Starting up context bigbluebutton"), LogLineEvent.SERVER_RESTARTED)
+]
+
+def old_fields(line):
+    """
+    (type, user id, username, room id, audio id) of the line by the old patterns,
+    or None if none of them matches
+    """
+    for regex, type in OLD_REGEXES:
+        match = regex.match(line)
+        if match:
+            groups = match.groupdict()
+            return (type, groups.get('user_id'), groups.get('user_name'),
+                groups.get('room_id'), groups.get('audio_id'))
+    return None
+
+def new_fields(line):
+    """
+    the same fields, from the event classify() returns
+    """
+    event = classify(line)
+    if event is None:
+        return None
+    return (event.type(), event.user_id(), event.username(), event.room_id(), event.audio_id())
+
+def compare(filename):
+    """
+    classifies every line of the log with both; returns the number of lines,
+    of events and the mismatches, as (line number, old fields, new fields)
+    """
+    lines = events = 0
+    mismatches = []
+    for line in open(filename, 'r'):
+        lines += 1
+        old = old_fields(line)
+        if old is not None:
+            events += 1
+        new = new_fields(line)
+        if old != new:
+            mismatches.append((lines, old, new))
+    return lines, events, mismatches
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in ['-h', '--help']:
+        print "usage: " + sys.argv[0] + " [logfile ...]"
+        print "checks that LogLineEvent finds the same events, with the same fields,"
+        print "as the old patterns did; without [logfile] a log with %d steps is generated" % STEPS
+        sys.exit(0)
+
+    filenames = sys.argv[1:]
+    generated = None
+    if len(filenames) == 0:
+        fd, generated = tempfile.mkstemp(prefix='mconf-golden-', suffix='.log')
+        out = os.fdopen(fd, 'w')
+        LogGenerator(out, restarts=3).generate(STEPS)
+        out.close()
+        filenames = [generated]
+
+    failed = False
+    try:
+        for filename in filenames:
+            lines, events, mismatches = compare(filename)
+            print "%s: %d lines, %d events, %d mismatches" % (filename, lines, events, len(mismatches))
+            for number, old, new in mismatches[:10]:
+                print "  line %d: old %r, new %r" % (number, old, new)
+            failed = failed or len(mismatches) > 0
+    finally:
+        if generated is not None:
+            os.remove(generated)
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,161 @@
+#! /usr/bin/python
+
+import sys
+import random
+import datetime
+from optparse import OptionParser
+
+class LogGenerator:
+    """
+    LogGenerator writes a synthetic bigbluebutton log, with the same lines
+    LogLineEvent looks for (all of its 11 patterns) mixed with noise lines from
+    the same and other loggers. Rooms are created and destroyed, users join them,
+    get a name, switch audio and video on and off and leave, and the server is
+    restarted now and then. The output only depends on the parameters, so the
+    same seed always gives the same log.
+    """
+
+    NOISE = [
+        ('DEBUG', 'o.r.s.n.r.RTMPHandler', 'Message received: Ping'),
+        ('DEBUG', 'o.r.s.n.r.RTMPHandler', 'Connection closed - session %d'),
+        ('INFO ', 'o.b.c.BigBlueButtonApplication', '[clientid=%d] joining the presentation'),
+        ('DEBUG', 'o.b.conference.RoomsManager', 'Change participant status %d - raiseHand [false]'),
+        ('DEBUG', 'o.b.w.red5.voice.ClientManager', 'Participant %d muted'),
+        ('INFO ', 'o.b.c.s.p.ParticipantsApplication', 'Room presenter changed to %d'),
+        ('DEBUG', 'ROOT', 'Scanning for stale sessions (%d)')
+    ]
+
+    def __init__(self, out, seed=0, start=datetime.datetime(2012, 5, 10, 8, 0, 0),
+            rooms=10, users=8, audio=0.6, video=0.3, restarts=0, noise=3):
+        self.out = out
+        self.random = random.Random(seed)
+        self.time = start
+        self.max_rooms = rooms
+        self.max_users = users
+        self.audio = audio
+        self.video = video
+        self.restarts = restarts
+        self.noise = noise
+
+        self.rooms = {}     # room id -> set of user ids
+        self.users = {}     # user id -> {'name', 'room', 'audio_id', 'video'}
+        self.next_user = 0
+        self.next_audio = 0
+        self.next_room = 0
+
+    def write(self, level, logger, message):
+        self.time += datetime.timedelta(milliseconds=self.random.randint(0, 4000))
+        self.out.write('%s,%03d [NioProcessor-%d] %s %s - %s\n' % (self.time.strftime('%Y-%m-%d %H:%M:%S'),
+            self.time.microsecond / 1000, self.random.randint(1, 16), level, logger, message))
+
+        for i in xrange(self.random.randint(0, 2 * self.noise)):
+            level, logger, message = self.random.choice(LogGenerator.NOISE)
+            if '%d' in message:
+                message = message % self.random.randint(1, 1000)
+            self.out.write('%s,%03d [pool-1-thread-%d] %s %s - %s\n' % (self.time.strftime('%Y-%m-%d %H:%M:%S'),
+                self.time.microsecond / 1000, self.random.randint(1, 8), level, logger, message))
+
+    def restart(self):
+        self.write('DEBUG', 'ROOT', 'Starting up context bigbluebutton')
+        self.rooms = {}
+        self.users = {}
+
+    def create_room(self):
+        self.next_room += 1
+        room_id = 'room-%d' % self.next_room
+        self.rooms[room_id] = set()
+        self.write('INFO ', 'o.b.c.s.p.ParticipantsApplication', 'Creating room %s' % room_id)
+
+    def destroy_room(self, room_id):
+        self.write('INFO ', 'o.b.c.s.p.ParticipantsApplication', 'Destroying room %s' % room_id)
+        for user_id in self.rooms.pop(room_id):
+            del self.users[user_id]
+
+    def join(self, room_id):
+        self.next_user += 1
+        user_id = str(self.next_user)
+        name = 'User %d' % self.next_user
+        self.write('INFO ', 'o.b.c.BigBlueButtonApplication', '[clientid=%s] connected from 10.0.%d.%d' %
+            (user_id, self.random.randint(0, 255), self.random.randint(1, 254)))
+        self.write('DEBUG', 'o.b.c.BigBlueButtonApplication',
+            'User [userid=%s,username=%s,role=VIEWER,conference=%s] connected to room [%s]' % (user_id, name, room_id, room_id))
+        self.users[user_id] = {'name': name, 'room': room_id, 'audio_id': None, 'video': False}
+        self.rooms[room_id].add(user_id)
+
+    def leave(self, user_id):
+        user = self.users.pop(user_id)
+        self.rooms[user['room']].discard(user_id)
+        self.write('INFO ', 'o.b.c.BigBlueButtonApplication', '[clientid=%s] disconnnected from room' % user_id)
+
+    def toggle_audio(self, user_id):
+        user = self.users[user_id]
+        if user['audio_id'] is None:
+            self.next_audio += 1
+            user['audio_id'] = str(self.next_audio)
+            self.write('DEBUG', 'o.b.w.voice.internal.RoomManager', 'Joined [%s,%s,false,false]' % (user['audio_id'], user['name']))
+            self.write('DEBUG', 'o.b.w.red5.voice.ClientManager', 'Participant %sjoining room %s' % (user['name'], user['room']))
+        else:
+            self.write('DEBUG', 'o.b.w.red5.voice.ClientManager', 'Participant [%s,%s] leaving' % (user['audio_id'], user['room']))
+            user['audio_id'] = None
+
+    def toggle_video(self, user_id):
+        user = self.users[user_id]
+        user['video'] = not user['video']
+        self.write('DEBUG', 'o.b.conference.RoomsManager', 'Change participant status %s - hasStream [%s]' %
+            (user_id, 'true' if user['video'] else 'false'))
+
+    def generate(self, steps):
+        """
+        writes about steps events (joins and leaves write two lines), plus the noise
+        """
+        ## the restarts are evenly spread over the log
+        restart_steps = set([number * steps / (self.restarts + 1) for number in xrange(1, self.restarts + 1)])
+
+        for step in xrange(steps):
+            if step in restart_steps:
+                self.restart()
+                continue
+
+            r = self.random.random()
+            if r < 0.05 and len(self.rooms) < self.max_rooms or len(self.rooms) == 0:
+                self.create_room()
+            elif r < 0.40:
+                room_id = self.random.choice(sorted(self.rooms))
+                if len(self.rooms[room_id]) < self.max_users:
+                    self.join(room_id)
+            elif r < 0.55 and self.users:
+                user_id = self.random.choice(sorted(self.users))
+                if self.users[user_id]['audio_id'] is not None or self.random.random() < self.audio:
+                    self.toggle_audio(user_id)
+            elif r < 0.70 and self.users:
+                user_id = self.random.choice(sorted(self.users))
+                if self.users[user_id]['video'] or self.random.random() < self.video:
+                    self.toggle_video(user_id)
+            elif r < 0.97 and self.users:
+                self.leave(self.random.choice(sorted(self.users)))
+            elif self.rooms:
+                self.destroy_room(self.random.choice(sorted(self.rooms)))
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog [options] [logfile]")
+    parser.add_option('--steps', type='int', default=10000, help='number of events to write')
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--start', default='2012-05-10 08:00:00', help='time of the first line')
+    parser.add_option('--rooms', type='int', default=10, help='maximum number of rooms at a time')
+    parser.add_option('--users', type='int', default=8, help='maximum number of users per room')
+    parser.add_option('--audio', type='float', default=0.6, help='chance that a user turns the audio on')
+    parser.add_option('--video', type='float', default=0.3, help='chance that a user turns the video on')
+    parser.add_option('--restarts', type='int', default=0, help='number of server restarts')
+    parser.add_option('--noise', type='int', default=3, help='average number of noise lines per line')
+    options, args = parser.parse_args()
+
+    if len(args) < 1:
+        parser.print_usage()
+        sys.exit(0)
+
+    out = open(args[0], 'w')
+    generator = LogGenerator(out, options.seed,
+        datetime.datetime.strptime(options.start, '%Y-%m-%d %H:%M:%S'), options.rooms,
+        options.users, options.audio, options.video, options.restarts, options.noise)
+    generator.generate(options.steps)
+    out.close()
@@ -2,17 +2,44 @@
 
 import sys, os
 from LogLineEvent import *
-from StatTable import StatTable
+from StatTable import StatTable, acquire_lock
+from LogTail import LogTail
+from EventMerge import merge
+from Metrics import metrics
 
 if len(sys.argv) < 3:
-    print "usage: " + sys.argv[0] + " [logfile] [datafile]"
-    print "where [logfile] is the latest bigbluebutton log file and"
+    print "usage: " + sys.argv[0] + " [logfile ...] [datafile]"
+    print "where [logfile] are the latest bigbluebutton log files (the events"
+    print "                of all of them are merged by time) and"
     print "      [datafile] is the file for the output data"
     sys.exit(0)
 
-events = []
+logfiles = sys.argv[1:-1]
+datafile = sys.argv[-1]
 
-parse(sys.argv[1], events)
+## if the previous run is still going, let it finish
+lock = acquire_lock(datafile)
+if lock is None:
+    print "%s is locked by another run, skipping" % datafile
+    sys.exit(0)
+
+## only the lines appended since the last run are parsed, and events
+## are streamed into the table as they are read; each log has its own
+## checkpoint, named after it when there are several
+tails = []
+for logfile in logfiles:
+    if len(logfiles) == 1:
+        tails.append(LogTail(logfile, datafile + '.tail'))
+    else:
+        tails.append(LogTail(logfile, '%s.%s.tail' % (datafile, os.path.basename(logfile))))
+events = merge([iterparse(logfile, tail) for logfile, tail in zip(logfiles, tails)])
 
-statTable = StatTable(sys.argv[2])
+statTable = StatTable(datafile)
 statTable.update(events)
+
+## events newer than the latest datapoint will be read again next time
+for tail in tails:
+    tail.commit(statTable.latest())
+
+## what this run did, for the /metrics of the web server
+metrics.write(datafile + '.metrics')
@@ -0,0 +1,36 @@
+#! /usr/bin/python
+
+import sys
+import time
+import calendar
+
+from StatTable import StatTable, acquire_lock
+from EventArchive import EventArchive
+
+def parse_time(text):
+    ## times are given as in the log, and kept as the log timestamps are
+    return calendar.timegm(time.strptime(text, '%Y-%m-%d %H:%M:%S'))
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print "usage: " + sys.argv[0] + " [archive] [datafile] [from] [to]"
+        print "where [archive] is the events directory of a data file ([datafile].events)"
+        print "      [datafile] is the file for the replayed data"
+        print "      [from] and [to] optionally limit the events replayed, as 'YYYY-MM-DD HH:MM:SS'"
+        sys.exit(0)
+
+    start = None
+    end = None
+    if len(sys.argv) >= 4:
+        start = parse_time(sys.argv[3])
+    if len(sys.argv) >= 5:
+        end = parse_time(sys.argv[4])
+
+    lock = acquire_lock(sys.argv[2])
+    if lock is None:
+        print "%s is locked by another run, skipping" % sys.argv[2]
+        sys.exit(0)
+
+    ## the events are already archived, so the replayed table doesn't archive them again
+    archive = EventArchive(sys.argv[1], readonly=True)
+    archive.replay(StatTable(sys.argv[2], archive=False), start, end)
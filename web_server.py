@@ -4,43 +4,559 @@ import web
 import json
 import sys
 import os
+import gzip
+import hashlib
+import time
+import bisect
+import threading
+from cStringIO import StringIO
+from optparse import OptionParser
+from web.wsgiserver import CherryPyWSGIServer
 from daemon import Daemon
+from History import History
+from StatTable import read_data, data_version, read_manifest, response_filename
+import Series
+import Deflate
+from Metrics import metrics, read_summary, prometheus
+
+WINDOWS = ['daily', 'weekly', 'monthly', 'annually']
+
+## data files of the servers in the cluster manifest, by name
+servers = {}
+
+## windows already read, by data file and window: (data version, datapoints,
+## timestamps, idxs)
+windows = {}
+
+## JSON payloads already built, by data file and query: (data version, payload)
+PAYLOAD_CACHE_SIZE = 64
+payloads = {}
+
+## gzip-compressed responses, by ETag
+GZIP_CACHE_SIZE = 64
+compressed = {}
+
+## requests are answered by several threads; the caches above are only filled
+## by one of them at a time, so a burst of requests after the data changes
+## builds each payload once
+cache_lock = threading.Lock()
+
+## threads answering requests (--threads), seconds an idle keep-alive connection
+## is kept open, and connections waiting to be accepted
+SERVER_THREADS = 64
+SERVER_TIMEOUT = 5
+SERVER_QUEUE_SIZE = 256
+
+## responses are sent in pieces of this size
+CHUNK_SIZE = 65536
+
+## data versions of the files with streams open, kept up to date by a single
+## watcher thread, which wakes the streams (waiting on changed) when they move on
+versions = {}
+changed = threading.Condition()
+watcher = None
+WATCH_SECONDS = 1
+
+## a stream sends a comment when nothing happened for HEARTBEAT_SECONDS, so
+## proxies keep it open, and ends after STREAM_SECONDS, so it doesn't hold a
+## server thread forever; clients reconnect after RETRY_MS, resuming from the
+## last idx they got
+HEARTBEAT_SECONDS = 15
+STREAM_SECONDS = 600
+RETRY_MS = 2000
+
+## streams open at a time (--streams), each holding a server thread; they are
+## kept below SERVER_THREADS so /stats/ and /metrics always have threads left,
+## and more clients are told to retry after BUSY_RETRY_MS
+MAX_STREAMS = SERVER_THREADS / 4
+BUSY_RETRY_MS = 30000
+streams = threading.Semaphore(MAX_STREAMS)
+
+def configure(threads, max_streams=None):
+    """
+    sets the number of server threads and of streams open at a time, a quarter
+    of the threads by default; raises ValueError if no threads would be left
+    """
+    global SERVER_THREADS, MAX_STREAMS, streams
+    if max_streams is None:
+        max_streams = threads / 4
+    if threads < 1 or max_streams < 0 or max_streams >= threads:
+        raise ValueError('the streams must leave some of the %d threads free' % threads)
+    SERVER_THREADS = threads
+    MAX_STREAMS = max_streams
+    streams = threading.Semaphore(MAX_STREAMS)
+
+def datafile(server):
+    """
+    the data file for /stats/<server>: the one given on the command line (the
+    cluster table, when a manifest is given too) for '' and 'cluster', or the
+    one of a server in the manifest; None for unknown servers
+    """
+    if server in ['', 'cluster']:
+        return sys.argv[2]
+    return servers.get(server)
+
+def cached_window(filename, window, version):
+    """
+    the (version, datapoints, timestamps, idxs) of a window, read again only
+    when the data has changed
+    """
+    cached = windows.get((filename, window))
+    if cached is None or cached[0] != version:
+        points = read_data(filename, [window])[window]['datapoints']
+        cached = (version, points, [datapoint['timestamp'] for datapoint in points],
+            [datapoint['idx'] for datapoint in points])
+        windows[(filename, window)] = cached
+    return cached
+
+def datapoints(filename, window, version):
+    """
+    the datapoints of a window and their timestamps
+    """
+    cached = cached_window(filename, window, version)
+    return cached[1], cached[2]
+
+def since(filename, window, version, idx):
+    """
+    the datapoints of a window after the one with idx
+    """
+    cached = cached_window(filename, window, version)
+    return cached[1][bisect.bisect_right(cached[3], idx):]
+
+def select(filename, window, version, query):
+    """
+    the datapoints of a window in the time range of the query, downsampled to
+    its max_points; with history, the range goes on into the datapoints slid
+    out of the window
+    """
+    start, end, max_points, history = query
+    points, timestamps = datapoints(filename, window, version)
+    points = Series.time_range(points, timestamps, start, end)
+    if history and (len(timestamps) == 0 or start is None or start < timestamps[0]):
+        first = timestamps[0] if len(timestamps) > 0 else None
+        older = History(filename + '.history', readonly=True).datapoints(window, start, end)
+        points = [datapoint for datapoint in older if first is None or datapoint['timestamp'] < first] + points
+    if max_points is not None:
+        points = Series.downsample(points, max_points)
+    return {'datapoints': points}
+
+def cached_payload(key, version, build):
+    """
+    the JSON of what build() returns, rebuilt only when the data has changed
+    """
+    cached = payloads.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    cache_lock.acquire()
+    try:
+        ## another thread may have built it while we waited
+        cached = payloads.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        result = json.dumps(build())
+        if len(payloads) >= PAYLOAD_CACHE_SIZE:
+            payloads.clear()
+        payloads[key] = (version, result)
+        return result
+    finally:
+        cache_lock.release()
+
+def payload(filename, window, version, query):
+    """
+    the JSON payload for a window (or all of them) and query
+    """
+    def build():
+        if window == 'all':
+            return dict([(key, select(filename, key, version, query)) for key in WINDOWS])
+        return Series.transpose(select(filename, window, version, query))
+    return cached_payload((filename, window, query), version, build)
+
+def parse_cursor(value, keys):
+    """
+    the idx after which each of the windows in keys is wanted, from either a
+    single idx for all of them or 'window:idx' pairs separated by commas (see
+    cursor()), where the windows left out get all their datapoints. Raises
+    ValueError if it's neither
+    """
+    if ':' not in value:
+        return dict([(key, int(value)) for key in keys])
+
+    lasts = dict([(key, -1) for key in keys])
+    for item in value.split(','):
+        key, idx = item.split(':')
+        if key not in keys:
+            raise ValueError('unknown window: %s' % key)
+        lasts[key] = int(idx)
+    return lasts
+
+def cursor(lasts):
+    """
+    the 'window:idx' pairs for the idx of the last datapoint seen of each window
+    """
+    return ','.join(['%s:%d' % (key, lasts[key]) for key in WINDOWS if key in lasts])
+
+def daily_head(filename, version):
+    """
+    the idx of the latest daily datapoint, or -1
+    """
+    daily = datapoints(filename, 'daily', version)[0]
+    return daily[-1]['idx'] if len(daily) > 0 else -1
+
+def resume_idx(head, idx):
+    ## rolled up datapoints lag behind the daily ones, so only an idx past the
+    ## latest daily datapoint means the data was reset: the window is sent again
+    return idx if idx <= head else -1
+
+def delta(filename, window, version, lasts):
+    """
+    the JSON payload with the datapoints of a window (or all of them) after the
+    idx given for it in lasts, as they are stored, the idx of the latest daily
+    datapoint (head) and the cursor to ask for the next ones with (see cursor()).
+    Windows are written one at a time, so a rolled up datapoint can show up after
+    the daily one with its idx; each window is followed on its own
+    """
+    def build():
+        latest = daily_head(filename, version)
+        output = {}
+        sent = {}
+        for key in lasts:
+            idx = resume_idx(latest, lasts[key])
+            output[key] = since(filename, key, version, idx)
+            sent[key] = output[key][-1]['idx'] if len(output[key]) > 0 else idx
+        return {'head': latest, 'cursor': cursor(sent), 'datapoints': output}
+    return cached_payload((filename, window, 'since', cursor(lasts)), version, build)
+
+def compress(etag, parts):
+    """
+    the gzipped response for an ETag; parts() gives its strings, only called
+    when it's not cached
+    """
+    result = compressed.get(etag)
+    if result is not None:
+        return result
+
+    cache_lock.acquire()
+    try:
+        result = compressed.get(etag)
+        if result is None:
+            buf = StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode='wb')
+            for part in parts():
+                f.write(part)
+            f.close()
+            result = buf.getvalue()
+            if len(compressed) >= GZIP_CACHE_SIZE:
+                compressed.clear()
+            compressed[etag] = result
+        return result
+    finally:
+        cache_lock.release()
+
+def response_file(filename, window, deflated=False):
+    """
+    the file StatTable wrote with the response for a window (already compressed
+    with deflated), opened, and a version of it; None, None if there's none
+    """
+    try:
+        f = open(response_filename(filename, window, deflated), 'rb')
+    except IOError:
+        return None, None
+    st = os.fstat(f.fileno())
+    return f, (st.st_ino, st.st_mtime, st.st_size)
+
+def stream(parts):
+    """
+    the response for a list of strings, sent in pieces of at most CHUNK_SIZE, so
+    the cached payloads are not copied into a new string for every request
+    """
+    web.header('Content-Length', str(sum([len(part) for part in parts])))
+    return chunks(parts)
+
+def chunks(parts):
+    for part in parts:
+        for offset in xrange(0, len(part), CHUNK_SIZE):
+            yield part[offset:offset + CHUNK_SIZE]
+
+def stream_file(head, f, tail):
+    """
+    the response with the contents of the file f (from where it is) between head
+    and tail; the file is sent as it is, in pieces of CHUNK_SIZE
+    """
+    web.header('Content-Length', str(len(head) + os.fstat(f.fileno()).st_size - f.tell() + len(tail)))
+    return file_chunks(head, f, tail)
+
+def file_chunks(head, f, tail):
+    try:
+        yield head
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+        yield tail
+    finally:
+        f.close()
+
+def watch():
+    while True:
+        for filename in versions.keys():
+            version = data_version(filename)
+            if version != versions[filename]:
+                changed.acquire()
+                versions[filename] = version
+                changed.notifyAll()
+                changed.release()
+        time.sleep(WATCH_SECONDS)
+
+def wait_version(filename, version, timeout):
+    """
+    waits up to timeout seconds for the data of filename to change from version;
+    returns the current version
+    """
+    global watcher
+    changed.acquire()
+    try:
+        if watcher is None:
+            watcher = threading.Thread(target=watch)
+            watcher.daemon = True
+            watcher.start()
+        if filename not in versions:
+            versions[filename] = data_version(filename)
+        if versions[filename] == version:
+            changed.wait(timeout)
+        return versions[filename]
+    finally:
+        changed.release()
+
+def message(window, datapoint, lasts):
+    """
+    a server-sent event with a new datapoint of a window; its id is the cursor
+    of the last datapoints sent of each window, lasts
+    """
+    return 'id: %s\nevent: %s\ndata: %s\n\n' % (cursor(lasts), window, json.dumps(datapoint))
 
 class MconfStatisticsWebService:
-    def GET(self, window):
-        i = web.input(window='all', callback='(function(obj){})')
+    def GET(self, server):
+        start = time.time()
+        try:
+            return self.respond(server)
+        finally:
+            metrics.count('requests', web.ctx.status.split(' ')[0])
+            metrics.add_time('request', time.time() - start)
+
+    def respond(self, server):
+        filename = datafile(server)
+        if filename is None:
+            raise web.notfound()
+
+        i = web.input(window='all', callback='(function(obj){})', max_points=None, since_idx=None, history=None,
+            **{'from': None, 'to': None})
         window = i.window
         callback = i.callback
+        if window != 'all' and window not in WINDOWS:
+            raise web.badrequest()
+
+        ## optional time range (timestamps as in the datapoints), including the
+        ## ones no longer in the window with history=1, and resolution; or only
+        ## the datapoints after since_idx
+        try:
+            query = (i['from'] and float(i['from']), i.to and float(i.to), i.max_points and int(i.max_points),
+                i.history in ['1', 'true'])
+            since_idx = None
+            if i.since_idx:
+                since_idx = parse_cursor(i.since_idx, WINDOWS if window == 'all' else [window])
+        except ValueError:
+            raise web.badrequest()
+
         web.header('Content-Type', 'application/x-javascript')
+        gzipped = 'gzip' in web.ctx.env.get('HTTP_ACCEPT_ENCODING', '')
 
-        output = {}
+        ## whole windows are sent from the files written by StatTable, when
+        ## there are any, and everything else is built here from the data
+        f = None
+        deflated = False
+        if query == (None, None, None, False) and since_idx is None:
+            if gzipped:
+                f, version = response_file(filename, window, deflated=True)
+                deflated = f is not None
+            if f is None:
+                f, version = response_file(filename, window)
+        if f is None:
+            version = data_version(filename)
 
-        if window == 'all':
-            output = json.loads(file(sys.argv[2]).read())
-            
-        else:
-            obj = json.loads(file(sys.argv[2]).read())[window]
+        ## the response only depends on the data, the query and the callback
+        etag = '"%s"' % hashlib.md5(repr((filename, version, deflated, window, query,
+            since_idx and cursor(since_idx), callback))).hexdigest()
+        web.header('ETag', etag)
+        web.header('Vary', 'Accept-Encoding')
+        if web.ctx.env.get('HTTP_IF_NONE_MATCH') == etag:
+            if f is not None:
+                f.close()
+            raise web.notmodified()
 
-            # we take the first datapoint as a template for all others
-            keys = obj['datapoints'][0]['value'].keys()
-            for key in keys:
-                output[key] = []
-                for datapoint in obj['datapoints']:
-                    output[key].append([datapoint['timestamp'], datapoint['value'][key]])
+        ## the compressed file goes in a gzip member as it is, with the callback
+        ## around it in stored blocks (a file written by an older version, with
+        ## no compressed one yet, is sent uncompressed)
+        if f is not None:
+            if deflated:
+                web.header('Content-Encoding', 'gzip')
+                head, tail = Deflate.gzip_parts(callback + '(', Deflate.read_header(f), ')')
+                return stream_file(head, f, tail)
+            return stream_file(callback + '(', f, ')')
 
         # this is kinda bad, but it's what we need to implement
         # jsonp, otherwise it wouldn't work
-        return callback + '(' + json.dumps(output) + ')'
+        if since_idx is not None:
+            parts = [callback, '(', delta(filename, window, version, since_idx), ')']
+        else:
+            parts = [callback, '(', payload(filename, window, version, query), ')']
+
+        if gzipped:
+            web.header('Content-Encoding', 'gzip')
+            return stream([compress(etag, lambda: parts)])
+        return stream(parts)
+
+class StreamService:
+    def GET(self, server):
+        """
+        pushes the datapoints of a window (or all of them) as server-sent events,
+        as soon as they are written: the daily ones each minute, and the ones
+        rolled up from them when a frame is complete. The id of each event is the
+        cursor of the last datapoint sent of each window (see cursor()), so a
+        client that reconnects with Last-Event-ID (or ?last_idx=, which also takes
+        a single idx) gets the ones it missed; a new client only gets new ones
+        """
+        filename = datafile(server)
+        if filename is None:
+            raise web.notfound()
+
+        i = web.input(window='all', last_idx=None)
+        if i.window == 'all':
+            keys = WINDOWS
+        elif i.window in WINDOWS:
+            keys = [i.window]
+        else:
+            raise web.badrequest()
+
+        try:
+            lasts = web.ctx.env.get('HTTP_LAST_EVENT_ID') or i.last_idx
+            lasts = lasts and parse_cursor(lasts, keys) or None
+        except ValueError:
+            raise web.badrequest()
+
+        if not streams.acquire(False):
+            metrics.count('streams_refused')
+            raise web.HTTPError('503 Service Unavailable', {'Content-Type': 'text/event-stream',
+                'Retry-After': str(BUSY_RETRY_MS / 1000)}, 'retry: %d\n\n' % BUSY_RETRY_MS)
+
+        web.header('Content-Type', 'text/event-stream')
+        web.header('Cache-Control', 'no-cache')
+        web.header('X-Accel-Buffering', 'no')
+        metrics.count('streams')
+        return self.events(filename, keys, lasts)
+
+    def events(self, filename, keys, lasts):
+        ## web.py starts the generator right away, so the slot taken in GET()
+        ## is always given back here
+        try:
+            for chunk in self.messages(filename, keys, lasts):
+                yield chunk
+        finally:
+            streams.release()
+
+    def messages(self, filename, keys, lasts):
+        yield 'retry: %d\n\n' % RETRY_MS
+
+        version = data_version(filename)
+        if lasts is None:
+            lasts = {}
+            for key in keys:
+                points = datapoints(filename, key, version)[0]
+                lasts[key] = points[-1]['idx'] if len(points) > 0 else -1
+
+        end = time.time() + STREAM_SECONDS
+        while time.time() < end:
+            ## each window is followed on its own, since they are written one at
+            ## a time; rolled up datapoints have the idx of the last daily one in
+            ## them, so sorting by idx sends them right after it
+            latest = daily_head(filename, version)
+            updates = []
+            for order, key in enumerate(keys):
+                lasts[key] = resume_idx(latest, lasts[key])
+                updates.extend([(datapoint['idx'], order, key, datapoint)
+                    for datapoint in since(filename, key, version, lasts[key])])
+            if len(updates) > 0:
+                updates.sort()
+                chunk = []
+                for idx, order, key, datapoint in updates:
+                    lasts[key] = idx
+                    chunk.append(message(key, datapoint, lasts))
+                yield ''.join(chunk)
+                metrics.count('stream_events', None, len(updates))
+
+            current = wait_version(filename, version, min(HEARTBEAT_SECONDS, end - time.time()))
+            if current == version:
+                yield ': keep-alive\n\n'
+            version = current
+
+class MetricsService:
+    def GET(self):
+        """
+        the metrics saved by the last run for each data file (the default one and
+        the ones in the manifest), and the ones of the web server, in the text format
+        Prometheus scrapes
+        """
+        web.header('Content-Type', 'text/plain; version=0.0.4')
+
+        summaries = []
+        for name, filename in [('cluster' if servers else 'default', sys.argv[2])] + sorted(servers.items()):
+            summary = read_summary(filename + '.metrics')
+            if summary is not None:
+                summaries.append(({'server': name}, summary))
+        summaries.append(({'process': 'web_server'}, metrics.summary()))
+        return prometheus(summaries)
 
 class WSDaemon(Daemon):
     def run(self):
         urls = (
-            '/stats/(.*)', 'MconfStatisticsWebService'
+            '/stats/(.*)', 'MconfStatisticsWebService',
+            '/stream/(.*)', 'StreamService',
+            '/metrics', 'MetricsService'
         )
+        ## with a cluster manifest, each of its servers has its own series
+        if len(sys.argv) >= 4:
+            for name, logfile, filename in read_manifest(sys.argv[3]):
+                servers[name] = filename
+
+        ## no debugger or module reloading on each request
+        web.config.debug = False
         app = web.application(urls, globals())
-        app.run();
+
+        ## a pool of threads answers the requests (keeping connections alive),
+        ## instead of the development server started by app.run()
+        server = CherryPyWSGIServer(('0.0.0.0', int(sys.argv[1])), app.wsgifunc(),
+            numthreads=SERVER_THREADS, request_queue_size=SERVER_QUEUE_SIZE, timeout=SERVER_TIMEOUT)
+        try:
+            server.start()
+        except KeyboardInterrupt:
+            server.stop()
 
 if __name__ == "__main__":
+    ## dashboards following /stream/ each hold a thread, so the limits can be
+    ## raised for the number of them expected
+    parser = OptionParser(usage="usage: %prog [options] start|stop|restart [port] [datafile] [manifest]")
+    parser.add_option('--threads', type='int', default=SERVER_THREADS, help='threads answering requests')
+    parser.add_option('--streams', type='int', default=None,
+        help='streams open at a time, below the threads (default: a quarter of them)')
+    options, args = parser.parse_args()
+    try:
+        configure(options.threads, options.streams)
+    except ValueError as err:
+        parser.error(str(err))
+    sys.argv[1:] = args
+
     daemon = WSDaemon('/tmp/statistics-server.pid')
     if len(sys.argv) >= 2:
         if 'start' == sys.argv[1] and len(sys.argv) >= 4: 
@@ -56,5 +572,5 @@ if __name__ == "__main__":
             sys.exit(2)
         sys.exit(0)
     else:
-        print "usage: %s start|stop|restart" % sys.argv[0]
+        parser.print_usage()
         sys.exit(2)